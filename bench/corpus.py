@@ -0,0 +1,78 @@
+# Realistic-looking IRC traffic for the benchmarks. Everything is
+# generated from a fixed seed so runs are comparable.
+
+import random
+
+
+WORDS = (
+    'the quick brown fox jumps over lazy dog asyncio python irc bot '
+    'network channel server message reply command hello world lunch '
+    'deploy build failed passed merge branch release today tomorrow'
+).split()
+
+
+def nicks(rng, count):
+    return ['%s%d' % (rng.choice(WORDS), rng.randrange(1000))
+            for _ in range(count)]
+
+
+def text(rng, min_words=2, max_words=20):
+    return ' '.join(rng.choice(WORDS)
+                    for _ in range(rng.randint(min_words, max_words)))
+
+
+def privmsg_lines(count=1000, seed=1):
+    rng = random.Random(seed)
+    users = nicks(rng, 50)
+    channels = ['#%s' % word for word in WORDS[:10]]
+    return [
+        ':%s!~%s@host-%d.example.com PRIVMSG %s :%s' % (
+            nick, nick, rng.randrange(256), rng.choice(channels), text(rng),
+        )
+        for nick in (rng.choice(users) for _ in range(count))
+    ]
+
+
+def names_lines(count=200, per_line=40, seed=2):
+    rng = random.Random(seed)
+    return [
+        ':irc.example.com 353 sinap = #big :%s' % ' '.join(
+            rng.choice(('', '', '', '@', '+')) + nick
+            for nick in nicks(rng, per_line)
+        )
+        for _ in range(count)
+    ]
+
+
+def tagged_lines(count=1000, seed=3):
+    rng = random.Random(seed)
+    return [
+        '@time=2026-01-01T12:%02d:%02d.%03dZ;msgid=%08x;account=%s '
+        ':%s!~%s@host.example.com PRIVMSG #tagged :%s' % (
+            rng.randrange(60), rng.randrange(60), rng.randrange(1000),
+            rng.getrandbits(32), nick, nick, nick, text(rng),
+        )
+        for nick in nicks(rng, count)
+    ]
+
+
+def command_lines(prefix='!', seed=4):
+    # Commands matching the nargs forms registered by the benchmark
+    rng = random.Random(seed)
+    return [
+        '%snoargs' % prefix,
+        '%sexact %s %s' % (prefix, rng.choice(WORDS), rng.choice(WORDS)),
+        '%srange %s' % (prefix, rng.choice(WORDS)),
+        '%svarargs %s' % (prefix, text(rng)),
+        '%snonempty %s' % (prefix, text(rng)),
+        '%smixed %s %s' % (prefix, rng.choice(WORDS), text(rng)),
+        '%snotacommand %s' % (prefix, text(rng)),
+        text(rng),
+    ]
+
+
+def to_chunks(lines, size=65536):
+    # Join lines into data_received() sized chunks, splitting lines
+    # at chunk boundaries like a real socket would
+    data = ''.join(line + '\r\n' for line in lines).encode('utf-8')
+    return [data[i:i + size] for i in range(0, len(data), size)]
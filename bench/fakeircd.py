@@ -0,0 +1,182 @@
+# A minimal IRC server for load testing. It registers clients, lets
+# them join channels, answers pings and floods the joined channels
+# with simulated users' messages at a configurable rate. A share of the
+# messages are "!echo <token>" commands, and the time until the token
+# comes back from the client is recorded as the reply latency.
+
+import asyncio
+import random
+import time
+
+
+class Latencies(object):
+    def __init__(self):
+        # token -> time.monotonic() when sent
+        self.pending = {}
+        self.samples = []
+        self._counter = 0
+
+    def new_token(self):
+        self._counter += 1
+        token = 'lt%d' % self._counter
+        self.pending[token] = time.monotonic()
+        return token
+
+    def received(self, text):
+        for word in text.split():
+            sent = self.pending.pop(word, None)
+            if sent is not None:
+                self.samples.append(time.monotonic() - sent)
+
+    def summary(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return {'replies': 0, 'lost': len(self.pending)}
+
+        def pick(fraction):
+            return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+        return {
+            'replies': len(samples),
+            'lost': len(self.pending),
+            'p50': pick(0.5),
+            'p90': pick(0.9),
+            'p99': pick(0.99),
+            'max': samples[-1],
+        }
+
+
+class FakeClient(object):
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.nick = None
+        self.registered = asyncio.Event()
+        self.channels = set()
+
+    def send(self, line):
+        self.writer.write(line.encode('utf-8') + b'\r\n')
+
+    async def run(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                break
+            self.handle(line.decode('utf-8', 'replace').rstrip('\r\n'))
+
+        self.server.clients.discard(self)
+
+    def handle(self, line):
+        if ' :' in line:
+            line, trailing = line.split(' :', 1)
+            args = line.split() + [trailing]
+        else:
+            args = line.split()
+        if not args:
+            return
+
+        command, args = args[0].upper(), args[1:]
+        if command == 'NICK':
+            self.nick = args[0]
+        elif command == 'USER':
+            self.send(':fake.ircd 001 %s :Welcome' % self.nick)
+            self.registered.set()
+        elif command == 'PING':
+            self.send(':fake.ircd PONG fake.ircd :%s' % args[-1])
+        elif command == 'JOIN':
+            for channel in args[0].split(','):
+                self.join(channel)
+        elif command == 'PART':
+            self.channels.discard(args[0])
+            self.send(':%s!bot@fake PART %s' % (self.nick, args[0]))
+        elif command == 'PRIVMSG':
+            self.server.lines_from_client += 1
+            self.server.latencies.received(args[-1])
+
+    def join(self, channel):
+        self.channels.add(channel)
+        self.send(':%s!bot@fake JOIN %s' % (self.nick, channel))
+
+        users = self.server.users
+        members = random.sample(users, min(len(users), 50))
+        self.send(':fake.ircd 353 %s = %s :%s' % (
+            self.nick, channel, ' '.join([self.nick] + members),
+        ))
+        self.send(':fake.ircd 366 %s %s :End of NAMES list' %
+                  (self.nick, channel))
+
+
+class FakeIRCServer(object):
+    def __init__(self, port, users=1000, rate=100, command_share=0.1,
+                 churn_share=0.05, latencies=None):
+        self.port = port
+        self.users = ['user%d' % i for i in range(users)]
+        self.rate = rate
+        self.command_share = command_share
+        self.churn_share = churn_share
+        self.latencies = latencies or Latencies()
+
+        self.clients = set()
+        self.lines_to_client = 0
+        self.lines_from_client = 0
+
+        self._server = None
+        self._traffic = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self.accept, '127.0.0.1', self.port,
+        )
+
+    def stop(self):
+        if self._traffic:
+            self._traffic.cancel()
+        self._server.close()
+        for client in list(self.clients):
+            client.writer.close()
+
+    async def accept(self, reader, writer):
+        client = FakeClient(self, reader, writer)
+        self.clients.add(client)
+        await client.run()
+
+    def start_traffic(self):
+        self._traffic = asyncio.ensure_future(self.traffic())
+
+    async def traffic(self):
+        # Send rate lines per second in 10 ms ticks
+        tick = 0.01
+        owed = 0.0
+        while True:
+            await asyncio.sleep(tick)
+            owed += self.rate * tick
+            count, owed = int(owed), owed - int(owed)
+            for _ in range(count):
+                self.send_random_line()
+
+    def send_random_line(self):
+        clients = [client for client in self.clients if client.channels]
+        if not clients:
+            return
+
+        client = random.choice(clients)
+        channel = random.choice(tuple(client.channels))
+        user = random.choice(self.users)
+        prefix = '%s!~%s@sim.example.com' % (user, user)
+
+        roll = random.random()
+        if roll < self.command_share:
+            line = ':%s PRIVMSG %s :!echo %s' % (
+                prefix, channel, self.latencies.new_token(),
+            )
+        elif roll < self.command_share + self.churn_share:
+            line = ':%s %s %s' % (prefix, random.choice(('JOIN', 'PART')),
+                                  channel)
+        else:
+            line = ':%s PRIVMSG %s :%s' % (
+                prefix, channel, 'simulated chatter %d' % random.randrange(10**6),
+            )
+
+        client.send(line)
+        self.lines_to_client += 1
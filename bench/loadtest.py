@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+# End-to-end load test against local fake IRC servers. Starts the
+# servers, runs bin/sinap in a subprocess with a generated config
+# pointing at them, floods the bot's channels and reports the
+# received-to-replied latency of "!echo" commands and the bot's CPU
+# usage. Runs entirely offline.
+#
+# Usage:
+#
+#   ./bench/loadtest.py --networks 4 --channels 500 --rate 2000
+
+from pathlib import Path
+import sys
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from argparse import ArgumentParser
+import asyncio
+import os
+import signal
+import tempfile
+
+import yaml
+
+from fakeircd import FakeIRCServer, Latencies
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+ECHO_MODULE = '''\
+from sinap.module import Module
+
+
+class EchoModule(Module):
+    public_commands = {
+        'echo': {'nargs': ':', 'help': 'Echo the arguments back'},
+    }
+
+    def command_echo(self, user, scope, text):
+        self.say(scope, text)
+'''
+
+
+def write_config(directory, args):
+    moduledir = directory / 'modules'
+    moduledir.mkdir()
+    (moduledir / 'echo.py').write_text(ECHO_MODULE)
+
+    channels = ['#load%d' % i for i in range(args.channels)]
+    config = {
+        'nick': 'loadbot',
+        'logging': {'level': 'warning'},
+        'modulesets': {'load': str(moduledir)},
+        'reconnect': {'max_concurrent': args.networks},
+        'networks': {
+            'net%d' % i: {
+                'server': '127.0.0.1',
+                'port': args.port + i,
+                'channels': channels,
+                # Don't let the flood protection dominate the latency
+                'send_burst': 10**9,
+            }
+            for i in range(args.networks)
+        },
+    }
+    path = directory / 'config.yml'
+    with path.open('w') as fobj:
+        yaml.safe_dump(config, fobj)
+    return path
+
+
+def cpu_seconds(pid):
+    # utime + stime of the process, Linux only
+    try:
+        with open('/proc/%d/stat' % pid) as fobj:
+            fields = fobj.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+async def wait_for_joins(servers, channels, timeout=60):
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline:
+        joined = sum(len(client.channels)
+                     for server in servers for client in server.clients)
+        if joined >= channels * len(servers):
+            return True
+        await asyncio.sleep(0.1)
+    return False
+
+
+async def run(args):
+    latencies = Latencies()
+    per_network_rate = args.rate / args.networks
+    servers = [
+        FakeIRCServer(args.port + i, users=args.users, rate=per_network_rate,
+                      command_share=args.commands, latencies=latencies)
+        for i in range(args.networks)
+    ]
+    for server in servers:
+        await server.start()
+
+    directory = Path(tempfile.mkdtemp(prefix='sinap-load-'))
+    config = write_config(directory, args)
+    bot = await asyncio.create_subprocess_exec(
+        sys.executable, str(ROOT / 'bin' / 'sinap'), '-c', str(config),
+        cwd=str(ROOT),
+    )
+
+    try:
+        if not await wait_for_joins(servers, args.channels):
+            print('Timed out waiting for the bot to join its channels')
+            return
+
+        print('Bot joined %d channels on %d networks, running for %ds' % (
+            args.channels, args.networks, args.duration,
+        ))
+
+        cpu_before = cpu_seconds(bot.pid)
+        for server in servers:
+            server.start_traffic()
+        await asyncio.sleep(args.duration)
+        cpu_after = cpu_seconds(bot.pid)
+
+        for server in servers:
+            server.stop()
+
+        # Give the last replies a moment to arrive
+        await asyncio.sleep(1)
+    finally:
+        if bot.returncode is None:
+            bot.send_signal(signal.SIGTERM)
+            await bot.wait()
+
+    sent = sum(server.lines_to_client for server in servers)
+    replies = sum(server.lines_from_client for server in servers)
+    summary = latencies.summary()
+
+    print('Lines sent to bot:   %d (%.0f/s)' % (sent, sent / args.duration))
+    print('Lines from bot:      %d' % replies)
+    print('Echo replies:        %d, lost %d' % (summary['replies'],
+                                               summary['lost']))
+    if summary['replies']:
+        print('Reply latency:       p50 %.1f ms, p90 %.1f ms, p99 %.1f ms, '
+              'max %.1f ms' % tuple(1000 * summary[key] for key in
+                                    ('p50', 'p90', 'p99', 'max')))
+    if cpu_before is not None and cpu_after is not None:
+        print('Bot CPU:             %.0f%%' %
+              (100 * (cpu_after - cpu_before) / args.duration))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--networks', type=int, default=2)
+    parser.add_argument('--channels', type=int, default=100,
+                        help='Channels per network [default: 100]')
+    parser.add_argument('--users', type=int, default=1000,
+                        help='Simulated users per network [default: 1000]')
+    parser.add_argument('--rate', type=float, default=500,
+                        help='Lines per second in total [default: 500]')
+    parser.add_argument('--commands', type=float, default=0.05,
+                        help='Share of lines that are !echo commands '
+                             '[default: 0.05]')
+    parser.add_argument('--duration', type=int, default=10,
+                        help='Seconds to run [default: 10]')
+    parser.add_argument('--port', type=int, default=16667,
+                        help='First server port [default: 16667]')
+    args = parser.parse_args()
+
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
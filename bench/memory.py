@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# Memory benchmark. Feeds 100k lines of realistic traffic through the
+# protocol, connection and bot dispatch and reports, per 100k
+# messages:
+#
+#   retained  memory still allocated after processing them, i.e. what
+#             grows with uptime (caches, leaks)
+#   held      memory taken by the parsed messages and their users if
+#             something keeps them, e.g. a module buffering them
+#
+# Usage:
+#
+#   ./bench/memory.py
+#   ./bench/memory.py --messages 1000000
+
+from pathlib import Path
+import sys
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from argparse import ArgumentParser
+import gc
+import tracemalloc
+
+from microbench import drain, make_bot, protocol
+
+import corpus
+
+
+def traffic(count):
+    # Channel chatter from a few hundred users, some commands and
+    # NAMES replies, like after joining channels
+    lines = (corpus.privmsg_lines(count=5000) +
+             corpus.tagged_lines(count=500) +
+             [corpus.privmsg_lines(count=1)[0].rsplit(':', 1)[0] + ':' + line
+              for line in corpus.command_lines()] * 50 +
+             corpus.names_lines(count=100))
+    while len(lines) < count:
+        lines += lines
+    return corpus.to_chunks(lines[:count])
+
+
+def measure_retained(count):
+    bot, net = make_bot()
+    proto = protocol(net.process_message)
+
+    def run():
+        for chunk in traffic(count):
+            proto.data_received(chunk)
+            drain(bot.loop)
+
+    # Warm up so that one-time allocations and bounded caches filling
+    # up aren't counted. Tracing starts before it, so that objects
+    # allocated by it and freed later are subtracted.
+    tracemalloc.start()
+    run()
+    gc.collect()
+
+    before = tracemalloc.get_traced_memory()[0]
+    run()
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return retained
+
+
+def measure_held(count):
+    bot, net = make_bot()
+    messages = []
+    proto = protocol(messages.append)
+    chunks = traffic(count)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    users = []
+    for chunk in chunks:
+        proto.data_received(chunk)
+    for message in messages:
+        if message.prefix:
+            users.append(net.parse_user(message.prefix))
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    # Subtract the lists themselves, they're the benchmark's
+    return held - sys.getsizeof(messages) - sys.getsizeof(users)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--messages', type=int, default=100000,
+                        help='Messages to process [default: 100000]')
+    args = parser.parse_args()
+
+    scale = 100000 / args.messages
+    retained = measure_retained(args.messages) * scale
+    held = measure_held(args.messages) * scale
+
+    print('Per 100k messages:')
+    print('  retained  %12.0f bytes' % retained)
+    print('  held      %12.0f bytes (%.0f per message)' % (
+        held, held / 100000,
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+
+# Microbenchmarks for the protocol and dispatch hot paths.
+#
+# Usage:
+#
+#   ./bench/microbench.py                 run and compare with baseline
+#   ./bench/microbench.py --save          run and store a new baseline
+#   ./bench/microbench.py -k parse        run benchmarks matching "parse"
+#
+# Prints operations per second and the peak memory allocated per
+# operation, including temporary objects freed before it returns.
+
+from pathlib import Path
+import sys
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from argparse import ArgumentParser
+import asyncio
+import gc
+import json
+import logging
+import tempfile
+import time
+import tracemalloc
+
+from sinap.bot import Bot, BotIRCConnection
+from sinap.irc import IRCProtocol
+from sinap.module import Module
+
+import corpus
+
+
+DEFAULT_BASELINE = Path(__file__).resolve().parent / 'baseline.json'
+
+
+class NullTransport(object):
+    def write(self, data):
+        pass
+
+
+class ListTransport(object):
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+
+class BenchModule(Module):
+    public_commands = {
+        'noargs': 'No arguments',
+        'exact': {'nargs': 2},
+        'range': {'nargs': (0, 2)},
+        'varargs': {'nargs': '*'},
+        'nonempty': {'nargs': ':'},
+        'mixed': {'nargs': (1, '*')},
+    }
+
+    def command_noargs(self, user, scope):
+        pass
+
+    def command_exact(self, user, scope, a, b):
+        pass
+
+    def command_range(self, user, scope, *args):
+        pass
+
+    def command_varargs(self, user, scope, *args):
+        pass
+
+    def command_nonempty(self, user, scope, args):
+        pass
+
+    def command_mixed(self, user, scope, first, rest=None):
+        pass
+
+    def on_message(self, user, scope, message):
+        pass
+
+
+def make_bot():
+    # A Bot with the benchmark module registered, but no networks
+    # connected and no core modules loaded
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    config = tempfile.NamedTemporaryFile('w', suffix='.yml', delete=False)
+    config.write('nick: sinap\nlogging: {level: error}\n')
+    config.close()
+
+    bot = Bot(config.name, loop=loop)
+    bot.setup_logging()
+    bot.log = bot.logger('core')
+    bot.admin_masks = []
+    bot.modules = {}
+    bot.exports = {}
+    bot.admin_commands = {}
+    bot.public_commands = {}
+    bot.command_prefix = '!'
+
+    module = BenchModule(bot, {}, bot.logger('bench'))
+    module.qualified_name = 'bench:bench'
+    bot.message_handlers = [module.on_message]
+    bot.irc_message_handlers = []
+    bot.register_commands(module, module.public_commands, public=True)
+
+    net = BotIRCConnection(
+        bot, 'bench', {'server': 'irc.example.com', 'nick': 'sinap'},
+        bot.logger('bench'), loop,
+    )
+    return bot, net
+
+
+def drain(loop):
+    # Run the callbacks scheduled so far
+    loop.call_soon(loop.stop)
+    loop.run_forever()
+
+
+def protocol(callback=None):
+    proto = IRCProtocol(callback or (lambda message: None),
+                        logging.getLogger('bench'))
+    proto.log.setLevel(logging.ERROR)
+    proto.connection_made(NullTransport())
+    return proto
+
+
+# Each benchmark returns (function, units). Calling function processes
+# units items, e.g. lines, and results are reported per unit. The
+# function may return its results, e.g. parsed messages, so that the
+# memory they take is included in the allocation figure even if the
+# benchmark would otherwise free them one by one.
+
+def bench_parse_privmsg():
+    proto = protocol()
+    lines = corpus.privmsg_lines()
+
+    def run():
+        return [proto.parse_message(line) for line in lines]
+    return run, len(lines)
+
+
+def bench_parse_names():
+    proto = protocol()
+    lines = corpus.names_lines()
+
+    def run():
+        return [proto.parse_message(line) for line in lines]
+    return run, len(lines)
+
+
+def bench_parse_tagged():
+    proto = protocol()
+    lines = corpus.tagged_lines()
+
+    def run():
+        return [proto.parse_message(line) for line in lines]
+    return run, len(lines)
+
+
+def bench_data_received_names():
+    received = []
+    proto = protocol(received.append)
+    lines = corpus.names_lines(count=1000)
+    chunks = corpus.to_chunks(lines)
+
+    def run():
+        del received[:]
+        for chunk in chunks:
+            proto.data_received(chunk)
+        return list(received)
+    return run, len(lines)
+
+
+def bench_send_message():
+    proto = protocol()
+    transport = ListTransport()
+    proto.connection_made(transport)
+    messages = [line.split(' ', 3)[2:] for line in corpus.privmsg_lines()]
+
+    def run():
+        transport.written = []
+        for target, text in messages:
+            proto.send_message('PRIVMSG', target, text[1:])
+        return transport.written
+    return run, len(messages)
+
+
+def bench_process_message():
+    bot, net = make_bot()
+    proto = protocol()
+    messages = [proto.parse_message(line)
+                for line in corpus.privmsg_lines() + corpus.names_lines()]
+
+    def run():
+        for message in messages:
+            net.process_message(message)
+        drain(bot.loop)
+    return run, len(messages)
+
+
+def bench_process_batch():
+    # Like process_message, but the messages are handled as one
+    # batch, as they are with batch_dispatch enabled
+    bot, net = make_bot()
+    proto = protocol()
+    messages = [proto.parse_message(line)
+                for line in corpus.privmsg_lines() + corpus.names_lines()]
+
+    def run():
+        net.process_batch(messages)
+        drain(bot.loop)
+    return run, len(messages)
+
+
+def bench_on_privmsg():
+    bot, net = make_bot()
+    lines = corpus.command_lines() * 50
+    sender = 'someone!~someone@host.example.com'
+
+    def run():
+        for line in lines:
+            bot.on_privmsg(net, sender, '#bench', line)
+        drain(bot.loop)
+    return run, len(lines)
+
+
+def bench_validate_args():
+    bot, net = make_bot()
+    cases = [
+        ('', 0),
+        ('one two', 2),
+        ('one', (0, 2)),
+        ('a b c d e', '*'),
+        ('a b c d e', ':'),
+        ('first rest of the line', (1, '*')),
+        ('first rest of the line', (1, ':')),
+        ('too many args here', 1),
+    ] * 10
+
+    def run():
+        return [bot.validate_args(args, nargs) for args, nargs in cases]
+    return run, len(cases)
+
+
+BENCHMARKS = [
+    (name[len('bench_'):], fn)
+    for name, fn in sorted(globals().items())
+    if name.startswith('bench_')
+]
+
+
+def measure(setup, min_time):
+    run, units = setup()
+
+    # Warm up and calibrate
+    calls = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(calls):
+            run()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time / 10:
+            break
+        calls *= 2
+
+    calls = max(1, int(calls * min_time / elapsed / 3))
+    best = float('inf')
+    gc.collect()
+    for _ in range(3):
+        started = time.perf_counter()
+        for _ in range(calls):
+            run()
+        best = min(best, time.perf_counter() - started)
+
+    ops = calls * units / best
+
+    # Peak memory allocated during a call, per unit. This includes
+    # the temporary objects of the last unit, not only what's still
+    # referenced when it returns. Tracing is restarted for each call
+    # to reset the peak.
+    total = 0
+    rounds = 5
+    for _ in range(rounds):
+        tracemalloc.start()
+        result = run()
+        total += tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del result
+
+    return {'ops': ops, 'bytes': total / rounds / units}
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-k', '--filter', default='',
+                        help='Only run benchmarks whose name contains this')
+    parser.add_argument('-t', '--time', type=float, default=1.0,
+                        help='Approximate seconds per benchmark [default: 1]')
+    parser.add_argument('-b', '--baseline', default=str(DEFAULT_BASELINE),
+                        help='Baseline file [default: bench/baseline.json]')
+    parser.add_argument('--save', action='store_true',
+                        help='Store the results as the new baseline')
+    args = parser.parse_args()
+
+    baseline = {}
+    if Path(args.baseline).exists():
+        with open(args.baseline) as fobj:
+            baseline = json.load(fobj)
+
+    results = {}
+    print('%-24s %14s %12s %10s' % (
+        'benchmark', 'ops/sec', 'peak B/op', 'change',
+    ))
+    for name, setup in BENCHMARKS:
+        if args.filter not in name:
+            continue
+
+        result = results[name] = measure(setup, args.time)
+        old = baseline.get(name)
+        change = ''
+        if old:
+            change = '%+.1f%%' % (100.0 * (result['ops'] / old['ops'] - 1))
+        print('%-24s %14.0f %12.0f %10s' % (
+            name, result['ops'], result['bytes'], change,
+        ))
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, 'w') as fobj:
+            json.dump(baseline, fobj, indent=2, sort_keys=True)
+        print('Baseline saved to %s' % args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,35 @@
 from functools import partial
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
+from socket import AF_INET
 import asyncio
+import atexit
+import heapq
 import inspect
+import itertools
 import logging
 import os
+import queue
+import random
 import signal
 import sys
+import time
 
 import yaml
 
+from sinap.cache import CommandCache
+from sinap.capture import CaptureWriter
+from sinap.connector import (
+    DNSCache, connect_staggered, create_ssl_context, interleave_families,
+)
 from sinap.irc import IRCConnection
+from sinap.metrics import Registry
 from sinap.module import Module
 from sinap.scope import Scope
+from sinap.storage import Storage
+from sinap.supervisor import RemoteNetwork, WorkerLink, assign_networks
+from sinap.trace import Tracer
+from sinap.watchdog import Watchdog
 
 
 DEFAULT_PORT = 6667
@@ -19,20 +37,103 @@ DEFAULT_PORT_SSL = 6697
 
 
 class Backoff:
-    def __init__(self, max_wait=300, exponent=1.8):
-        self._current = 2
+    def __init__(self, initial=2, max_wait=300, factor=2, jitter=0.5):
+        self._initial = initial
         self._max_wait = max_wait
-        self._exponent = exponent
+        self._factor = factor
+        self._jitter = jitter
+        self._attempt = 0
 
-    async def sleep(self):
-        if self._current > self._max_wait:
-            self._current = self._max_wait
+    def next_delay(self):
+        delay = min(self._max_wait, self._initial * self._factor ** self._attempt)
+        self._attempt += 1
+
+        # Randomize the delay so that networks that failed at the same
+        # time don't all retry in lockstep
+        return delay * (1 - self._jitter * random.random())
 
-        await asyncio.sleep(self._current)
-        self._current **= self._exponent
+    async def sleep(self):
+        await asyncio.sleep(self.next_delay())
 
     def reset(self):
-        self._current = 2
+        self._attempt = 0
+
+
+class ReconnectScheduler:
+    # Bot-wide gate for connection attempts. At most max_concurrent
+    # attempts run at a time, and waiting networks are let through in
+    # priority order (lower first), then in the order they arrived.
+
+    def __init__(self, loop, max_concurrent=2):
+        self.loop = loop
+        self.max_concurrent = max_concurrent
+
+        self._active = 0
+        self._waiting = []
+        self._counter = itertools.count()
+
+        # netname -> dict of reconnect statistics
+        self.stats = {}
+
+    def configure(self, max_concurrent):
+        self.max_concurrent = max(1, max_concurrent)
+        self._wake()
+
+    async def acquire(self, priority=0):
+        if self._active < self.max_concurrent and not self._waiting:
+            self._active += 1
+            return
+
+        future = self.loop.create_future()
+        heapq.heappush(self._waiting, (priority, next(self._counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # A slot was already handed to us, pass it on
+                self.release()
+            raise
+
+    def release(self):
+        self._active -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiting and self._active < self.max_concurrent:
+            _, _, future = heapq.heappop(self._waiting)
+            if not future.done():
+                self._active += 1
+                future.set_result(None)
+
+    def record_failure(self, netname):
+        self._stats_for(netname)['failures'] += 1
+
+    def record_reconnect(self, netname, duration):
+        stats = self._stats_for(netname)
+        stats['reconnects'] += 1
+        stats['last_duration'] = duration
+        stats['total_duration'] += duration
+
+    def _stats_for(self, netname):
+        return self.stats.setdefault(netname, {
+            'reconnects': 0,
+            'failures': 0,
+            'last_duration': 0.0,
+            'total_duration': 0.0,
+        })
+
+
+class DeferredQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # QueueHandler formats the message before queueing it. Leave
+        # that to the listener thread, and only render the traceback
+        # now because the frames may change after this returns.
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info,
+            )
+            record.exc_info = None
+        return record
 
 
 class NameMunglingFormatter(logging.Formatter):
@@ -41,19 +142,66 @@ class NameMunglingFormatter(logging.Formatter):
         return logging.Formatter.format(self, record)
 
 
+def parse_servers(config):
+    # Return the list of (host, port) pairs from a network config.
+    # Servers can be given as a single server/port, or as a list in
+    # servers, each item being "host", "host:port" or a mapping with
+    # server and port keys. IPv6 addresses with a port must be written
+    # in brackets, e.g. "[2001:db8::1]:6697".
+    ssl = config.get('ssl', False)
+    default_port = config.get('port', DEFAULT_PORT_SSL if ssl else DEFAULT_PORT)
+
+    items = config.get('servers') or []
+    if config.get('server'):
+        items = [config['server']] + items
+
+    servers = []
+    for item in items:
+        if isinstance(item, dict):
+            host = item.get('server')
+            port = item.get('port', default_port)
+        elif str(item).startswith('['):
+            host, _, port = str(item)[1:].partition(']')
+            port = port[1:] if port.startswith(':') else default_port
+        elif str(item).count(':') == 1:
+            host, port = str(item).split(':')
+        else:
+            host, port = item, default_port
+
+        if not host:
+            raise ValueError('Invalid server: %r' % item)
+
+        try:
+            servers.append((host, int(port)))
+        except ValueError:
+            raise ValueError('Invalid port for %s: %r' % (host, port))
+
+    if not servers:
+        raise ValueError('host not specified')
+
+    return servers
+
+
+def network_gauge(bot, name, function):
+    # Return a gauge callback that calls function with the connection
+    # of the named network. The connection is looked up each time, so
+    # that the metrics don't keep an old connection alive.
+    def get():
+        net = bot.networks.get(name)
+        return function(net) if net is not None else 0
+    return get
+
+
 class BotIRCConnection(IRCConnection):
     def __init__(self, bot, name, config, logger, loop=None):
-        host = config.get('server')
+        servers = parse_servers(config)
         nick = config.get('nick')
 
-        if not host:
-            raise ValueError('host not specified')
-
         if not nick:
             raise ValueError('nick not specified')
 
         ssl = config.get('ssl', False)
-        port = config.get('port', DEFAULT_PORT_SSL if ssl else DEFAULT_PORT)
+        host, port = servers[0]
 
         super().__init__(
             host=host,
@@ -65,31 +213,175 @@ class BotIRCConnection(IRCConnection):
             realname=config.get('realname'),
             logger=logger,
             delegate=bot,
+            history=config.get('protocol_history', 0),
+            capture=self.make_capture(bot, name, config),
             loop=loop,
         )
         self.name = name
-        self.new_host = None
-        self.new_port = None
+        self.servers = servers
+        self.connect_delay = config.get('connect_delay', 0.25)
+
+        # Send at most send_burst lines in a row, then one line every
+        # send_burst_wait seconds
+        self._max_send_burst = config.get('send_burst', 3)
+        self._send_burst_wait = config.get('send_burst_wait', 2.0)
+
+        self._apply_backpressure(config)
+
+        # Handle all lines read at once in a single callback
+        self._batch_dispatch = config.get('batch_dispatch', False)
+
+        # Drop messages repeating one sent to the same target less
+        # than dedup_window seconds ago
+        self._dedup_window = config.get('dedup_window', 0)
+        self._dedup_size = config.get('dedup_size', 1024)
+
+        self._dns_cache = bot.dns_cache
+
+        # The SSL context lives as long as the connection object, so
+        # TLS sessions can be resumed on reconnect
+        if ssl:
+            self.ssl = create_ssl_context(
+                cafile=config.get('ssl_cafile'),
+                verify=config.get('ssl_verify', True),
+            )
+
+        # Wall clock time of the restart this connection was taken
+        # over from, until the first line has been processed
+        self.restarted_at = None
+
+        self._tracer = bot.tracer
+        self.lines_received = bot.metrics.counter(
+            'sinap_lines_received_total', 'Lines received from the server',
+            ['network'],
+        ).labels(name)
+        self.lines_sent = bot.metrics.counter(
+            'sinap_lines_sent_total', 'Lines sent to the server', ['network'],
+        ).labels(name)
+        self.send_wait = bot.metrics.histogram(
+            'sinap_send_queue_wait_seconds',
+            'Time spent by outgoing lines in the send queue', ['network'],
+        ).labels(name)
+        self._gauges = [
+            bot.metrics.gauge(
+                'sinap_send_queue_depth', 'Lines waiting in the send queue',
+                ['network'],
+            ),
+            bot.metrics.gauge(
+                'sinap_dispatch_outstanding',
+                'Handlers and commands scheduled but not finished',
+                ['network'],
+            ),
+        ]
+        self._gauges[0].labels(name).set_function(network_gauge(
+            bot, name, lambda net: len(net._send_queue),
+        ))
+        self._gauges[1].labels(name).set_function(network_gauge(
+            bot, name, lambda net: net._outstanding,
+        ))
+        self.lines_suppressed = bot.metrics.counter(
+            'sinap_lines_suppressed_total',
+            'Outgoing lines dropped as duplicates', ['network', 'command'],
+        )
+        self.read_paused = bot.metrics.histogram(
+            'sinap_read_paused_seconds',
+            'Time reading from the server was paused because handlers '
+            'fell behind', ['network'],
+        ).labels(name)
+
+    @staticmethod
+    def make_capture(bot, name, config):
+        capture = config.get('capture')
+        if not capture:
+            return None
+
+        if not bot.datadir:
+            raise ValueError('capture requires datadir')
+
+        options = capture if isinstance(capture, dict) else {}
+        return CaptureWriter(
+            bot.loop, bot.datadir / 'captures' / name, name,
+            max_bytes=options.get('max_bytes', 16 * 1024 * 1024),
+            max_age=options.get('max_age', 3600),
+            keep=options.get('keep', 24),
+        )
 
-    async def connect(self, reuse_fd=None):
-        if self.new_host and self.new_port:
-            self.host = self.new_host
-            self.port = self.new_port
-            self.new_host = self.new_port = None
+    async def connect_args(self):
+        # Resolve all servers in parallel and race connections to
+        # them, starting a new attempt every connect_delay seconds
+        results = await asyncio.gather(*[
+            self._dns_cache.resolve(host, port) for host, port in self.servers
+        ], return_exceptions=True)
+
+        candidates = []
+        for (host, port), result in zip(self.servers, results):
+            if isinstance(result, Exception):
+                self.log.warning('Unable to resolve %s: %s' % (host, result))
+                continue
+            for addrinfo in interleave_families(result):
+                candidates.append(((host, port), addrinfo))
 
-        await super().connect(reuse_fd=reuse_fd)
+        if not candidates:
+            raise OSError('Unable to resolve any server')
+
+        try:
+            (host, port), sock = await connect_staggered(
+                self._loop, candidates, self.connect_delay,
+            )
+        except OSError:
+            # Maybe the addresses have changed
+            for host, port in self.servers:
+                self._dns_cache.invalidate(host, port)
+            raise
+
+        self.host = host
+        self.port = port
+
+        connect_kwds = {'sock': sock}
+        if self.ssl:
+            connect_kwds['ssl'] = self.ssl
+            connect_kwds['server_hostname'] = host
+        return connect_kwds
+
+    async def connect(self, *args, **kwds):
+        await super().connect(*args, **kwds)
+
+        if self.ssl and self._transport:
+            ssl_object = self._transport.get_extra_info('ssl_object')
+            if ssl_object:
+                self.log.debug('TLS session reused: %s',
+                               ssl_object.session_reused)
+                # Session tickets arrive after the handshake, so they
+                # are available only after registration
+                self.ssl.save_session(self.host, ssl_object)
+
+    def message_sent(self, command, args, queued_at, trace):
+        now = time.monotonic()
+        self.lines_sent.inc()
+        self.send_wait.observe(now - queued_at)
+        if trace is not None:
+            self._tracer.finish(trace, self.name, args[0], queued_at, now)
+
+    def message_suppressed(self, command, args):
+        self.lines_suppressed.labels(self.name, command).inc()
+
+    def remove_metrics(self):
+        # Called when the network is removed
+        for gauge in self._gauges:
+            gauge.remove(self.name)
+
+    def reading_resumed(self, duration):
+        self.read_paused.observe(duration)
 
     def reconfigure(self, config):
-        host = config.get('server')
+        parse_servers(config)
         nick = config.get('nick')
 
-        if not host:
-            raise ValueError('host not specified')
-
         if not nick:
             raise ValueError('nick not specified')
 
         self._apply_changes(config)
+        self._apply_backpressure(config)
 
         # Join new channels
         for channel in config.get('channels', []):
@@ -101,28 +393,62 @@ class BotIRCConnection(IRCConnection):
         # manually.
 
     def dump_state(self):
-        # About to restart, make the fd inheritable
+        # Nothing to hand over while reconnecting. The new process
+        # connects from scratch.
+        if self._transport is None or self._transport.is_closing():
+            return None
         socket = self._transport.get_extra_info('socket')
-        if socket:
-            socket.set_inheritable(True)
+        if socket is None or socket.fileno() < 0:
+            return None
 
-        return {
+        if self._capture is not None:
+            self._capture.close()
+
+        # About to restart, make the fd inheritable
+        os.set_inheritable(socket.fileno(), True)
+
+        state = {
             'server': self.host,
             'port': self.port,
             'fileno': socket.fileno(),
+            'family': int(socket.family),
             'nick': self.nick,
             'channels': self.channels,
             'password': self.password,
         }
-
-    async def load_state(self, state):
-        await self.connect(reuse_fd=state['fileno'])
+        state.update(self.dump_buffers())
+        return state
+
+    async def load_state(self, state, restarted_at=None):
+        await self.connect(
+            reuse_fd=state['fileno'],
+            family=state.get('family', AF_INET),
+            recv_buffer=state.get('recv_buffer', b''),
+        )
+        self.load_buffers(state)
+        self.restarted_at = restarted_at
         self.channels = state['channels']
+        # The server may not be the first configured one if the old
+        # process had failed over
+        self.host, self.port = state['server'], state['port']
         self._apply_changes(state)
 
+    def _apply_backpressure(self, config):
+        # Stop reading from the server while dispatch_high_water
+        # handlers and commands are unfinished, until they're down to
+        # dispatch_low_water or max_read_pause seconds have passed
+        self._high_water = config.get('dispatch_high_water', 1000)
+        self._low_water = config.get('dispatch_low_water', 100)
+        self._max_pause = config.get('max_read_pause', 30.0)
+
+        # Apply the new limits to the current backlog right away
+        if not self._high_water or self._outstanding <= self._low_water:
+            self.resume_reading()
+        elif self._outstanding >= self._high_water:
+            self.pause_reading()
+
     def _apply_changes(self, config):
-        host = config['server']
-        port = config.get('port', 6667)
+        self.servers = parse_servers(config)
         nick = config['nick']
 
         if 'password' in config:
@@ -132,9 +458,8 @@ class BotIRCConnection(IRCConnection):
         if 'realname' in config:
             self.realname = config['realname']
 
-        if self.host != host or self.port != port:
-            self.new_host = host
-            self.new_port = port
+        if (self.host, self.port) not in self.servers:
+            # Connected to a server that's no longer configured
             self.nick = nick
             self.disconnect()
         elif self.nick != nick:
@@ -143,11 +468,14 @@ class BotIRCConnection(IRCConnection):
 
 
 class Bot(object):
-    def __init__(self, config_file, state_file=None, loop=None):
+    def __init__(self, config_file, state_file=None, loop=None,
+                 worker=None, workers=1, ipc=None):
         # Load configuration here to catch errors early on
         self.config_file = config_file
         self.load_config()
 
+        self.logging_handler = None
+
         if state_file:
             with open(state_file) as fobj:
                 self.state = yaml.safe_load(fobj)
@@ -157,23 +485,111 @@ class Bot(object):
 
         self.loop = loop or asyncio.get_event_loop()
 
+        self.metrics = Registry()
+        self.handler_seconds = self.metrics.histogram(
+            'sinap_handler_seconds', 'Time spent in module handlers',
+            ['module'],
+        )
+        self.reconnect_count = self.metrics.counter(
+            'sinap_reconnects_total', 'Successful reconnects', ['network'],
+        )
+        self.reconnect_failures = self.metrics.counter(
+            'sinap_reconnect_failures_total', 'Failed connection attempts',
+            ['network'],
+        )
+        self.reload_seconds = self.metrics.gauge(
+            'sinap_reload_seconds', 'Duration of the last reload',
+        )
+        self.command_cache_requests = self.metrics.counter(
+            'sinap_command_cache_total',
+            'Invocations of cached commands by cache result',
+            ['command', 'result'],
+        )
+        self.tracer = Tracer(self.metrics)
+
+        # Created in run() when logging has been set up
+        self.watchdog = None
+
+        # Opened on the first reload, in datadir if there is one
+        self.storage = None
+
+        # When running as one of several worker processes, worker is
+        # this process's index and ipc the supervisor's socket path
+        self.worker = worker
+        self.workers = workers
+        self.ipc = WorkerLink(self, ipc) if ipc else None
+
         # netname -> IRCConnection
         self.networks = {}
 
+        # netname -> RemoteNetwork for networks owned by other workers
+        self.remote_networks = {}
+
         # netname -> Future
         self.connecting = {}
 
         # netname -> timeout handle
         self.pings = {}
 
+        self.reconnects = ReconnectScheduler(self.loop)
+        self.dns_cache = DNSCache(self.loop)
+
     def run(self):
         self.reload(initial=True)
         self.loop.add_signal_handler(signal.SIGUSR1, self.handle_usr1)
 
+        self.watchdog = Watchdog(self)
+        self.configure_watchdog()
+
+        if self.ipc:
+            self.loop.create_task(self.ipc.run())
+
+    def configure_watchdog(self):
+        config = self.config.get('watchdog', {})
+        if config is False:
+            self.watchdog.stop()
+            return
+
+        self.watchdog.configure(
+            interval=config.get('interval', 0.25),
+            threshold=config.get('threshold', 0.5),
+            disable_after=config.get('disable_after'),
+        )
+        self.watchdog.start()
+
     def handle_usr1(self, signum=None, frame=None):
         self.log.info('SIGUSR1 received, reloading config')
         self.reload()
 
+    def request_reload(self):
+        # With workers, all of them must reload together to agree on
+        # which worker owns which network
+        if self.ipc:
+            self.ipc.send({'type': 'reload'})
+        else:
+            self.reload()
+
+    def get_network(self, netname):
+        # Return the local or remote network by name, or None
+        return self.networks.get(netname) or self.remote_networks.get(netname)
+
+    def network_configs(self):
+        net_configs = self.config.get('networks', {})
+        if self.worker is None:
+            return net_configs
+
+        assignment = assign_networks(net_configs, self.workers)
+        self.remote_networks = {
+            netname: RemoteNetwork(self.ipc, netname)
+            for netname, worker in assignment.items()
+            if worker != self.worker
+        }
+        return {
+            netname: config
+            for netname, config in net_configs.items()
+            if assignment[netname] == self.worker
+        }
+
     def load_config(self):
         with open(self.config_file) as fobj:
             self.config = yaml.safe_load(fobj)
@@ -188,21 +604,41 @@ class Bot(object):
         levelno = getattr(logging, level.upper())
         fmt = '[%(asctime)-15s][%(name)-20s] %(levelname)s %(message)s'
 
+        if self.logging_handler is None:
+            # Loggers put records to a queue, and a background thread
+            # formats and writes them, so the event loop never blocks
+            # on the terminal or a pipe
+            records = queue.Queue()
+            self._stream_handler = logging.StreamHandler()
+            self.logging_handler = DeferredQueueHandler(records)
+            self._log_listener = QueueListener(
+                records, self._stream_handler, respect_handler_level=True,
+            )
+            self._log_listener.start()
+            atexit.register(self._log_listener.stop)
+
         # Set up the name mungling formatter for our own loggers
         formatter = NameMunglingFormatter(fmt)
-        self.logging_handler = logging.StreamHandler()
-        self.logging_handler.propagate = False
+        self._stream_handler.setLevel(levelno)
+        self._stream_handler.setFormatter(formatter)
         self.logging_handler.setLevel(levelno)
-        self.logging_handler.setFormatter(formatter)
+
+        # Loggers filter by level too, so that disabled debug calls
+        # return before creating a record
+        self.log_level = levelno
+        for name, logger in list(logging.Logger.manager.loggerDict.items()):
+            if name.startswith('sinap.loggers.') and \
+                    isinstance(logger, logging.Logger):
+                logger.setLevel(levelno)
 
     def logger(self, name):
         if '.' in name:
             raise ValueError("'.' not allowed in logger name")
 
         logger = logging.getLogger('sinap.loggers.' + name)
-        logger.setLevel('DEBUG')
-        logger.handlers = []
-        logger.addHandler(self.logging_handler)
+        logger.setLevel(self.log_level)
+        if logger.handlers != [self.logging_handler]:
+            logger.handlers = [self.logging_handler]
         return logger
 
     def is_admin(self, user):
@@ -217,6 +653,10 @@ class Bot(object):
         self.modules = {}
         self.exports = {}
         self.message_handlers = []
+        self.irc_message_handlers = []
+
+        # source file path -> qualified module name
+        self.module_files = {}
 
         self.admin_commands = {}
         self.public_commands = {}
@@ -270,7 +710,7 @@ class Bot(object):
                         break
                 else:
                     self.log.info('Failed to load module %s' % qualified_name)
-                    self.log.debug("%s doesn't define a Module subclass" %
+                    self.log.debug("%s doesn't define a Module subclass",
                                    qualified_name)
                     continue
 
@@ -278,7 +718,9 @@ class Bot(object):
                 logger = self.logger(qualified_name)
                 try:
                     module = ctor(self, module_config, logger)
+                    module.qualified_name = qualified_name
                     self.modules[qualified_name] = module
+                    self.module_files[str(modulepath)] = qualified_name
                 except:
                     self.log.info('Failed to load module %s' % qualified_name)
                     self.log.debug('Uncaught exception', exc_info=True)
@@ -303,12 +745,42 @@ class Bot(object):
             if on_message:
                 self.message_handlers.append(on_message)
 
+            on_irc_message = getattr(module, 'on_irc_message', None)
+            if on_irc_message:
+                self.irc_message_handlers.append(on_irc_message)
+
             admin_commands = getattr(module, 'admin_commands', {})
             self.register_commands(module, admin_commands, public=False)
 
             public_commands = getattr(module, 'public_commands', {})
             self.register_commands(module, public_commands, public=True)
 
+    def disable_module(self, qualified_name):
+        # Shut down a module and remove its handlers until the next
+        # reload
+        module = self.modules.pop(qualified_name)
+        try:
+            module._shutdown()
+        except:
+            self.log.exception('Unable to shut down module %s' %
+                               qualified_name)
+
+        self.message_handlers = [
+            handler for handler in self.message_handlers
+            if getattr(handler, '__self__', None) is not module
+        ]
+        self.irc_message_handlers = [
+            handler for handler in self.irc_message_handlers
+            if getattr(handler, '__self__', None) is not module
+        ]
+        for commands in (self.admin_commands, self.public_commands):
+            for name, handler in list(commands.items()):
+                if handler['module'] is module:
+                    del commands[name]
+        for name, export in list(self.exports.items()):
+            if export is module:
+                del self.exports[name]
+
     def register_commands(self, module, commands, public):
         targets = [self.admin_commands]
         if public:
@@ -326,6 +798,10 @@ class Bot(object):
                 help = opts.get('help', '')
                 aliases = opts.get('aliases', [])
 
+            cache = None
+            if not isinstance(opts, str) and opts.get('cache'):
+                cache = CommandCache.from_opts(opts['cache'])
+
             fn = getattr(module, 'command_%s' % name, None)
             if callable(fn):
                 handler = {
@@ -336,6 +812,7 @@ class Bot(object):
                     'help': help,
                     'aliases': aliases,
                     'run': fn,
+                    'cache': cache,
                 }
                 for target in targets:
                     target[name] = handler
@@ -345,6 +822,8 @@ class Bot(object):
                 self.log.warning('No callable handler for command %s' % name)
 
     def reload(self, initial=False):
+        started = time.perf_counter()
+
         if not initial:
             # Reload configuration
             self.load_config()
@@ -354,6 +833,10 @@ class Bot(object):
 
         if 'datadir' in self.config:
             self.datadir = Path(self.config['datadir'])
+            if self.worker is not None:
+                # Workers don't share the restart state, storage or
+                # logs, each has a directory of its own
+                self.datadir = self.datadir / ('worker-%d' % self.worker)
             if not self.datadir.exists():
                 self.datadir.mkdir(parents=True)
             if not self.datadir.is_dir():
@@ -361,10 +844,31 @@ class Bot(object):
         else:
             self.datadir = None
 
+        storage_config = self.config.get('storage', {})
+        if self.storage is None:
+            if self.datadir:
+                path = self.datadir / 'storage.db'
+            else:
+                self.log.warning('No datadir, module data is not persisted')
+                path = ':memory:'
+            self.storage = Storage(self.loop, path, self.logger('storage'))
+        self.storage.flush_delay = storage_config.get('flush_delay', 1.0)
+
         self.admin_masks = self.config.get('admins', [])
+
+        reconnect_config = self.config.get('reconnect', {})
+        self.reconnects.configure(reconnect_config.get('max_concurrent', 2))
+        self.dns_cache.ttl = self.config.get('dns_ttl', 300)
+
+        tracing_config = self.config.get('tracing', {})
+        self.tracer.configure(
+            slow_threshold=tracing_config.get('slow_threshold', 2.0),
+            keep=tracing_config.get('keep', 100),
+        )
+
         self.load_modules(initial)
 
-        net_configs = self.config.get('networks', {})
+        net_configs = self.network_configs()
         for netname, config in sorted(net_configs.items()):
             # Lookup some defaults from the global config
             for field in ('nick', 'username', 'realname'):
@@ -393,19 +897,50 @@ class Bot(object):
             if not config and netname in self.networks:
                 # Network has been removed from config, disconnect
                 self.networks[netname].disconnect()
+                self.networks[netname].remove_metrics()
                 del self.networks[netname]
 
+        if self.watchdog:
+            self.configure_watchdog()
+
+        self.reload_seconds.set(time.perf_counter() - started)
+
     def restart(self):
         if not self.datadir:
             raise ValueError('Restart is not possible without datadir')
 
-        state = {'networks': {}}
+        # Dump everything and write it out before shutting anything
+        # down, so that the bot keeps running as before if this fails
+        state = {'networks': {}, 'modules': {}}
+        for qualified_name, module in self.modules.items():
+            try:
+                module_state = module.dump_state()
+            except Exception:
+                self.log.exception('Unable to dump the state of %s' %
+                                   qualified_name)
+                module_state = None
+            if module_state is not None:
+                state['modules'][qualified_name] = module_state
+
         for netname, net in self.networks.items():
-            state['networks'][netname] = net.dump_state()
+            net_state = net.dump_state()
+            if net_state is not None:
+                state['networks'][netname] = net_state
 
         state_file = Path(self.datadir) / 'state.yml'
-        with state_file.open('w') as fobj:
-            yaml.dump(state, fobj)
+        self._write_restart_state(state_file, state)
+
+        # Let the modules write out what they have buffered, like on
+        # reload, and carry the lines they said on shutdown over in the
+        # send queues
+        for qualified_name, module in self.modules.items():
+            try:
+                module._shutdown()
+            except Exception:
+                self.log.exception('Error shutting down %s' % qualified_name)
+        for netname, net_state in state['networks'].items():
+            net_state.update(self.networks[netname].dump_buffers())
+        self._write_restart_state(state_file, state)
 
         new_args = sys.argv.copy()
         try:
@@ -414,9 +949,21 @@ class Bot(object):
         except ValueError:
             new_args += ['--state', str(state_file)]
 
-        self.log.debug('Executing %s' % new_args)
+        self.log.debug('Executing %s', new_args)
+
+        self.storage.close()
+
+        # Flush the log queue, it doesn't survive exec
+        self._log_listener.stop()
         os.execv(new_args[0], new_args)
 
+    def _write_restart_state(self, state_file, state):
+        with state_file.open('w') as fobj:
+            # Take the timestamp as late as possible to measure the
+            # dead time until the new process handles its first line
+            state['time'] = time.time()
+            yaml.safe_dump(state, fobj)
+
     async def connect(self, netname, config):
         log = self.logger(netname)
         try:
@@ -426,35 +973,51 @@ class Bot(object):
             return
 
         state = self.state.get('networks', {}).get(netname)
-        backoff = Backoff()
+
+        reconnect_config = self.config.get('reconnect', {})
+        backoff = Backoff(**{
+            key: reconnect_config[key]
+            for key in ('initial', 'max_wait', 'factor', 'jitter')
+            if key in reconnect_config
+        })
+
+        # Time when the connection was lost, None on the first connect
+        lost_at = None
 
         while True:
             if state:
                 log.info('Reusing old connection')
-                await net.load_state(state)
+                await net.load_state(state, self.state.get('time'))
                 net.reconfigure(config)
                 state = None
             else:
-                future = asyncio.ensure_future(net.connect())
+                future = asyncio.ensure_future(
+                    self.connect_when_scheduled(net, config.get('priority', 0))
+                )
                 self.connecting[netname] = future
 
-                # net.connect may change net.host and net.port, so
-                # print them afterwards
-                log.info('Connecting to %s:%s' % (net.host, net.port))
+                log.info('Connecting to %s' % ', '.join(
+                    '%s:%s' % server for server in net.servers
+                ))
                 try:
                     await future
                 except asyncio.CancelledError:
                     # Connection attempt cancelled
                     return
                 except Exception as exc:
-                    log.error('Failed to connect to %s:%s: %s' % (
-                        net.host, net.port, exc,
-                    ))
+                    log.error('Failed to connect: %s' % exc)
+                    self.reconnects.record_failure(netname)
+                    self.reconnect_failures.labels(netname).inc()
                     await backoff.sleep()
                     continue
                 else:
-                    log.info('Connected')
+                    log.info('Connected to %s:%s' % (net.host, net.port))
                     backoff.reset()
+                    if lost_at is not None:
+                        self.reconnects.record_reconnect(
+                            netname, self.loop.time() - lost_at,
+                        )
+                        self.reconnect_count.labels(netname).inc()
                 finally:
                     self.connecting.pop(netname, None)
 
@@ -465,6 +1028,7 @@ class Bot(object):
                 if channel not in net.channels:
                     net.join(channel)
             await net.wait_for_disconnect()
+            lost_at = self.loop.time()
 
             if netname in self.pings:
                 self.pings[netname].cancel()
@@ -473,6 +1037,17 @@ class Bot(object):
             log.info('Connection lost to %s:%s, reconnecting' %
                      (net.host, net.port))
 
+            # Don't reconnect immediately. If the uplink went down,
+            # all networks were dropped at the same time.
+            await backoff.sleep()
+
+    async def connect_when_scheduled(self, net, priority):
+        await self.reconnects.acquire(priority)
+        try:
+            await net.connect()
+        finally:
+            self.reconnects.release()
+
     def validate_args(self, args, nargs):
         # nargs can be one of:
         #
@@ -518,7 +1093,8 @@ class Bot(object):
             # Invalid message
             return
 
-        scope = Scope(net, user, target)
+        msg = net.current_message
+        received = msg.received if msg else None
 
         if message.startswith(self.command_prefix):
             # Command
@@ -536,10 +1112,15 @@ class Bot(object):
 
             handler = commands.get(command, None)
             if handler:
+                trace = self.tracer.start(handler['name'], received)
+                scope = Scope(net, user, target, trace=trace)
                 args = self.validate_args(args, handler['nargs'])
-                if args is not None:
+                if args is not None and handler['cache']:
+                    self.dispatch_cached(handler, user, scope, args, trace)
+                elif args is not None:
                     run = handler['run']
-                    self.run_async_callback(run, user, scope, *args)
+                    self.dispatch(run, (user, scope) + tuple(args), {}, trace,
+                                  net=net)
                 else:
                     net.privmsg(scope.target, 'Usage: %s%s' % (
                         self.command_prefix,
@@ -547,28 +1128,138 @@ class Bot(object):
                     ))
                 return
 
-        # Not a registered command, call plain message handlers
+        # Not a registered command, call plain message handlers. Each
+        # gets its own trace so replies are attributed to the right
+        # module.
         for handler in self.message_handlers:
-            self.run_async_callback(handler, user, scope, message)
+            trace = self.tracer.start('message', received)
+            scope = Scope(net, user, target, trace=trace)
+            self.dispatch(handler, (user, scope, message), {}, trace,
+                          net=net)
+
+    def dispatch_cached(self, handler, user, scope, args, trace):
+        cache = handler['cache']
+        key = cache.key(scope, args)
+        requests = self.command_cache_requests
+
+        replies = cache.get(key)
+        if replies is not None:
+            requests.labels(handler['name'], 'hit').inc()
+            trace.module = handler['module'].qualified_name
+            for reply in replies:
+                scope.net.privmsg(scope.target, reply, trace=trace)
+            return
+
+        waiting = cache.inflight.get(key)
+        if waiting is not None:
+            requests.labels(handler['name'], 'coalesced').inc()
+            waiting.append(scope)
+            return
+
+        requests.labels(handler['name'], 'miss').inc()
+        cache.inflight[key] = waiting = []
+        # Module.say() records the replies to the scope
+        scope.recorder = []
+
+        def done(exc):
+            del cache.inflight[key]
+            if exc is None:
+                cache.put(key, scope.recorder)
+                for waiter in waiting:
+                    for reply in scope.recorder:
+                        waiter.net.privmsg(waiter.target, reply,
+                                           trace=waiter.trace)
+            else:
+                # Failures are not cached, let the others try
+                for waiter in waiting:
+                    self.dispatch(handler['run'],
+                                  (waiter.user, waiter) + tuple(args), {},
+                                  waiter.trace, net=waiter.net)
+
+        self.dispatch(handler['run'], (user, scope) + tuple(args), {}, trace,
+                      done=done, net=scope.net)
 
     def run_async_callback(self, callback, *args, **kwds):
         # Run a callback asynchronously whether it is a normal
         # function or a coroutine function
+        self.dispatch(callback, args, kwds)
+
+    def dispatch(self, callback, args, kwds, trace=None, done=None,
+                 net=None):
+        # done, if given, is called with the exception raised by the
+        # callback, or None, when it has finished. If net is given,
+        # the callback counts as outstanding work of that network
+        # until then.
+        if net is not None:
+            done = net.track_work(done)
+
+        module = getattr(callback, '__self__', None)
+        module_name = getattr(module, 'qualified_name', None) or 'core'
+        timer = self.handler_seconds.labels(module_name)
+        if trace is not None:
+            trace.module = module_name
+
         if asyncio.iscoroutinefunction(callback):
-            self.loop.create_task(callback(*args, **kwds))
+            self.loop.create_task(
+                self.timed_coroutine(timer, trace, callback, args, kwds, done)
+            )
         else:
-            self.loop.call_soon(partial(callback, *args, **kwds))
+            self.loop.call_soon(
+                self.timed_call, timer, trace, callback, args, kwds, done
+            )
+
+    def timed_call(self, timer, trace, callback, args, kwds, done=None):
+        started = time.monotonic()
+        if trace is not None:
+            trace.started = started
+        try:
+            callback(*args, **kwds)
+        finally:
+            timer.observe(time.monotonic() - started)
+            if done is not None:
+                done(sys.exc_info()[1])
+
+    async def timed_coroutine(self, timer, trace, callback, args, kwds,
+                              done=None):
+        # Measures the whole run time of the coroutine, including
+        # time spent waiting
+        started = time.monotonic()
+        if trace is not None:
+            trace.started = started
+        try:
+            await callback(*args, **kwds)
+        finally:
+            timer.observe(time.monotonic() - started)
+            if done is not None:
+                done(sys.exc_info()[1])
 
     def handle_message(self, net, message):
+        self.handle_message_batch(net, [message])
+
+    def handle_message_batch(self, net, messages):
+        net.lines_received.inc(len(messages))
+
+        if net.restarted_at is not None:
+            net.log.info('First line processed %.3f seconds after restart' %
+                         (time.time() - net.restarted_at))
+            net.restarted_at = None
+
+        # Modules' on_irc_message(net, message) see every message.
+        # They are called directly, without the dispatch machinery,
+        # so they must be quick.
+        for message in messages:
+            for handler in self.irc_message_handlers:
+                try:
+                    handler(net, message)
+                except:
+                    self.log.exception('Error in %r', handler)
+
         # We got a message so the connection is alive. Reschedule the
         # ping for this network.
         if net.name in self.pings:
             self.pings[net.name].cancel()
             self.ping(net, schedule_only=True)
 
-    def on_ping(self, net, sender, *args):
-        net.send_message('PONG', *args)
-
     def ping(self, net, schedule_only=False):
         if not schedule_only:
             net.send_message('PING', net.host)
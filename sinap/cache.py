@@ -0,0 +1,63 @@
+from collections import OrderedDict
+import time
+
+
+# Caches the replies of commands declared with a 'cache' option:
+#
+#   public_commands = {
+#       'weather': {
+#           'nargs': 1,
+#           'cache': {'ttl': 300, 'size': 100, 'per_channel': False},
+#       },
+#   }
+#
+# 'cache': 300 is short for {'ttl': 300}. The replies a command says to
+# the scope it was invoked in are recorded, and identical invocations,
+# i.e. the same command and arguments (and channel if per_channel), are
+# answered with the same replies until ttl seconds have passed.
+# Identical invocations arriving while the command is still running
+# wait for it instead of running it again.
+
+class CommandCache(object):
+    def __init__(self, ttl=60, size=100, per_channel=False):
+        self.ttl = ttl
+        self.size = size
+        self.per_channel = per_channel
+
+        # key -> (expires, replies), least recently used first
+        self._entries = OrderedDict()
+
+        # key -> [Scope] waiting for the running invocation
+        self.inflight = {}
+
+    @classmethod
+    def from_opts(cls, opts):
+        if opts is True:
+            return cls()
+        if isinstance(opts, (int, float)):
+            return cls(ttl=opts)
+        return cls(**opts)
+
+    def key(self, scope, args):
+        if self.per_channel:
+            return (scope.net.name, scope.target.lower()) + tuple(args)
+        return tuple(args)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires, replies = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return replies
+
+    def put(self, key, replies):
+        self._entries[key] = (time.monotonic() + self.ttl, replies)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
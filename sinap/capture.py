@@ -0,0 +1,147 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import gzip
+import re
+import time
+
+
+# Capture files contain one received line per line of text:
+#
+#   <time.monotonic() when received> <raw line>
+#
+# Backslashes and newlines in the raw line are escaped so that the
+# bytes can be restored exactly.
+
+def escape(line):
+    return line.replace(b'\\', b'\\\\').replace(b'\n', b'\\n')
+
+
+UNESCAPE_RE = re.compile(rb'\\(.)', re.DOTALL)
+
+
+def unescape(data):
+    return UNESCAPE_RE.sub(
+        lambda match: b'\n' if match.group(1) == b'n' else match.group(1),
+        data,
+    )
+
+
+class CaptureWriter(object):
+    # Writes received lines to gzip compressed files in directory,
+    # starting a new file when the current one reaches max_bytes of
+    # uncompressed data or max_age seconds. Only the keep newest
+    # files, at least the current one, are kept. Lines are buffered
+    # and written out in batches at the latest flush_age seconds
+    # after they were received. Compression and file operations run
+    # in a background thread.
+
+    def __init__(self, loop, directory, prefix, max_bytes=16 * 1024 * 1024,
+                 max_age=3600, keep=24, buffer_size=65536, flush_age=1.0):
+        self.loop = loop
+        self.directory = Path(directory)
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.keep = max(1, keep)
+        self.buffer_size = buffer_size
+        self.flush_age = flush_age
+
+        if not self.directory.exists():
+            self.directory.mkdir(parents=True)
+
+        self._file = None
+        self._file_bytes = 0
+        self._file_opened = 0
+
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._flush_handle = None
+
+        # The file is only used in this thread
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def write(self, received, line):
+        record = b'%.6f %s\n' % (received, escape(line))
+        self._buffer.append(record)
+        self._buffer_bytes += len(record)
+
+        if self._buffer_bytes >= self.buffer_size:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(self.flush_age,
+                                                      self.flush)
+
+    def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        if not self._buffer:
+            return
+
+        data = b''.join(self._buffer)
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._executor.submit(self._write, data)
+
+    def close(self):
+        # Blocks until everything has been written
+        self.flush()
+        self._executor.submit(self._close_file)
+        self._executor.shutdown(wait=True)
+
+    # Run in the executor thread
+
+    def _write(self, data):
+        if self._file is None or self._should_rotate():
+            self._rotate()
+
+        self._file.write(data)
+        self._file.flush()
+        self._file_bytes += len(data)
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _should_rotate(self):
+        return (self._file_bytes >= self.max_bytes or
+                time.monotonic() - self._file_opened >= self.max_age)
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+
+        name = '%s-%s.cap.gz' % (self.prefix, time.strftime('%Y%m%d-%H%M%S'))
+        path = self.directory / name
+        # Don't overwrite if rotating twice within a second
+        counter = 1
+        while path.exists():
+            path = self.directory / ('%s.%d' % (name, counter))
+            counter += 1
+
+        self._file = gzip.open(str(path), 'wb')
+        self._file_bytes = 0
+        self._file_opened = time.monotonic()
+
+        files = sorted(self.directory.glob('%s-*.cap.gz*' % self.prefix),
+                       key=lambda path: path.stat().st_mtime)
+        for old in files[:-self.keep]:
+            old.unlink()
+
+
+def read_capture(paths):
+    # Yield (timestamp, raw line) from capture files in order
+    for path in paths:
+        with gzip.open(str(path), 'rb') as fobj:
+            try:
+                for record in fobj:
+                    if not record.endswith(b'\n'):
+                        break
+                    timestamp, _, line = record[:-1].partition(b' ')
+                    yield float(timestamp), unescape(line)
+            except EOFError:
+                # The file of a bot that was killed lacks the gzip
+                # trailer, but everything flushed to it is readable
+                pass
@@ -0,0 +1,228 @@
+from pathlib import Path
+import gzip
+import json
+import re
+import time
+
+
+# Storage and search for one channel's log. The log is split into
+# daily segments, <day>.log.gz, each line being
+#
+#   <unix time>\t<nick>\t<text>
+#
+# Every segment has an inverted index, word -> line numbers, which is
+# kept in memory for the segment being written and saved to
+# <day>.idx.gz when the day changes. words.gz maps each word to the
+# closed segments containing it, so a search only reads the segments
+# that contain all of its words.
+#
+# Not thread safe. Everything is meant to run in a single background
+# thread.
+
+WORD_RE = re.compile(r'\w\w+')
+
+
+def words(text):
+    return set(WORD_RE.findall(text.lower()))
+
+
+def day_of(timestamp):
+    return time.strftime('%Y-%m-%d', time.localtime(timestamp))
+
+
+def read_json(path, default):
+    try:
+        with gzip.open(str(path), 'rt', encoding='utf-8') as fobj:
+            return json.load(fobj)
+    except (OSError, EOFError, ValueError):
+        return default
+
+
+def write_json(path, data):
+    # Write to a temporary file and rename, so a crash leaves either
+    # the old or the new file
+    tmp = path.with_name(path.name + '.tmp')
+    with gzip.open(str(tmp), 'wt', encoding='utf-8') as fobj:
+        json.dump(data, fobj, separators=(',', ':'))
+    tmp.replace(path)
+
+
+def read_lines(path):
+    # Return the records of a segment as (time, nick, text) tuples
+    try:
+        with gzip.open(str(path), 'rt', encoding='utf-8',
+                       errors='replace') as fobj:
+            data = fobj.read()
+    except EOFError:
+        # Truncated by a crash, the complete part is still readable
+        # when read line by line
+        data = ''.join(iter_partial(path))
+    except OSError:
+        return []
+
+    # Not splitlines(), it splits at characters that may appear in
+    # the text too
+    records = []
+    for line in data.split('\n'):
+        fields = line.split('\t', 2)
+        if len(fields) == 3:
+            records.append((float(fields[0]), fields[1], fields[2]))
+    return records
+
+
+def iter_partial(path):
+    with gzip.open(str(path), 'rt', encoding='utf-8', errors='replace') as fobj:
+        try:
+            for line in fobj:
+                if line.endswith('\n'):
+                    yield line
+        except EOFError:
+            pass
+
+
+class ChannelLogStore(object):
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        if not self.directory.exists():
+            self.directory.mkdir(parents=True)
+
+        # The segment being written to
+        self.day = None
+        self.index = {}
+        self.line_count = 0
+
+        # word -> list of days of closed segments
+        self.words_path = self.directory / 'words.gz'
+        self.words = read_json(self.words_path, {})
+
+        self._recover()
+
+    def _segment_path(self, day):
+        return self.directory / ('%s.log.gz' % day)
+
+    def _index_path(self, day):
+        return self.directory / ('%s.idx.gz' % day)
+
+    def _days(self):
+        return sorted(path.name[:-len('.log.gz')]
+                      for path in self.directory.glob('*.log.gz'))
+
+    def _recover(self):
+        # Segments without an index were still being written when the
+        # bot stopped. Continue writing today's, close the others.
+        today = day_of(time.time())
+        for day in self._days():
+            if self._index_path(day).exists():
+                continue
+
+            self.day = day
+            self.index = {}
+            self.line_count = 0
+            for _, _, text in read_lines(self._segment_path(day)):
+                self._index_line(text)
+
+            if day != today:
+                self._close_segment()
+
+    def _index_line(self, text):
+        for word in words(text):
+            self.index.setdefault(word, []).append(self.line_count)
+        self.line_count += 1
+
+    def _close_segment(self):
+        if self.day is None:
+            return
+
+        write_json(self._index_path(self.day), self.index)
+        for word in self.index:
+            days = self.words.setdefault(word, [])
+            if self.day not in days:
+                days.append(self.day)
+        write_json(self.words_path, self.words)
+
+        self.day = None
+        self.index = {}
+        self.line_count = 0
+
+    def append(self, records):
+        # records is a list of (time, nick, text) in time order
+        chunk = []
+        for timestamp, nick, text in records:
+            day = day_of(timestamp)
+            if day != self.day:
+                self._write(chunk)
+                chunk = []
+                self._close_segment()
+                self.day = day
+
+            chunk.append('%.3f\t%s\t%s\n' % (
+                timestamp, nick, text.replace('\n', ' '),
+            ))
+            self._index_line(text)
+
+        self._write(chunk)
+
+    def _write(self, chunk):
+        if not chunk:
+            return
+        # Each write appends a new gzip member, which readers see as a
+        # continuation of the same stream
+        with gzip.open(str(self._segment_path(self.day)), 'at',
+                       encoding='utf-8') as fobj:
+            fobj.write(''.join(chunk))
+
+    def search(self, query, limit, skip_prefix=None):
+        # Return up to limit (time, nick, text) records containing all
+        # words of query, newest first. Lines starting with
+        # skip_prefix, e.g. bot commands, are left out.
+        query_words = words(query)
+        if not query_words:
+            return []
+
+        candidates = None
+        for word in query_words:
+            days = set(self.words.get(word, ()))
+            candidates = days if candidates is None else candidates & days
+        if self.day is not None and all(word in self.index
+                                        for word in query_words):
+            candidates.add(self.day)
+
+        results = []
+        for day in sorted(candidates, reverse=True):
+            if day == self.day:
+                index = self.index
+            else:
+                index = read_json(self._index_path(day), {})
+
+            line_numbers = None
+            for word in query_words:
+                found = set(index.get(word, ()))
+                line_numbers = (found if line_numbers is None
+                                else line_numbers & found)
+            if not line_numbers:
+                continue
+
+            records = read_lines(self._segment_path(day))
+            for line_number in sorted(line_numbers, reverse=True):
+                if line_number >= len(records):
+                    continue
+                record = records[line_number]
+                if skip_prefix and record[2].startswith(skip_prefix):
+                    continue
+                results.append(record)
+                if len(results) >= limit:
+                    return results
+
+        return results
+
+    def last(self, count):
+        # Return the count newest records, oldest first
+        if count < 1:
+            return []
+
+        records = []
+        for day in reversed(self._days()):
+            records = read_lines(self._segment_path(day)) + records
+            if len(records) >= count:
+                break
+        return records[-count:]
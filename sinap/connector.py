@@ -0,0 +1,149 @@
+import asyncio
+import itertools
+import socket
+import ssl
+
+
+class DNSCache(object):
+    # Caches getaddrinfo() results for ttl seconds, so that
+    # reconnecting doesn't have to wait for the resolver
+
+    def __init__(self, loop, ttl=300):
+        self.loop = loop
+        self.ttl = ttl
+
+        # (host, port) -> (expires, addrinfos)
+        self._cache = {}
+
+    async def resolve(self, host, port):
+        key = (host, port)
+        cached = self._cache.get(key)
+        if cached and cached[0] > self.loop.time():
+            return cached[1]
+
+        infos = await self.loop.getaddrinfo(
+            host, port, type=socket.SOCK_STREAM,
+        )
+        if self.ttl > 0:
+            self._cache[key] = (self.loop.time() + self.ttl, infos)
+        return infos
+
+    def invalidate(self, host, port):
+        self._cache.pop((host, port), None)
+
+
+class SessionCachingSSLContext(ssl.SSLContext):
+    # An SSLContext that remembers the last TLS session for each
+    # server name and offers it when connecting to the same name
+    # again, making the handshake an abbreviated one. asyncio creates
+    # its SSL objects with wrap_bio(), so that's where the session is
+    # passed in.
+
+    def __init__(self, *args, **kwds):
+        # server_hostname -> ssl.SSLSession
+        self.sessions = {}
+
+    def wrap_bio(self, incoming, outgoing, server_side=False,
+                 server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.sessions.get(server_hostname)
+
+        return super().wrap_bio(
+            incoming, outgoing,
+            server_side=server_side,
+            server_hostname=server_hostname,
+            session=session,
+        )
+
+    def save_session(self, server_hostname, ssl_object):
+        session = ssl_object and ssl_object.session
+        if session is not None:
+            self.sessions[server_hostname] = session
+
+
+def create_ssl_context(cafile=None, verify=True):
+    context = SessionCachingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    if verify:
+        if cafile:
+            context.load_verify_locations(cafile)
+        else:
+            context.load_default_certs()
+    else:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def interleave_families(addrinfos):
+    # Alternate between address families as recommended by RFC 8305,
+    # keeping the resolver's order within each family
+    by_family = {}
+    for info in addrinfos:
+        by_family.setdefault(info[0], []).append(info)
+
+    result = []
+    for infos in itertools.zip_longest(*by_family.values()):
+        result.extend(info for info in infos if info is not None)
+    return result
+
+
+async def connect_staggered(loop, candidates, delay=0.25):
+    # Happy eyeballs style connect. candidates is a list of (key,
+    # addrinfo) pairs. A new attempt is started every delay seconds,
+    # or immediately when the previous attempt fails, and the first
+    # successful one wins. Returns (key, sock) of the winner, raises
+    # OSError if all attempts fail.
+
+    async def attempt(addrinfo):
+        family, type_, proto, _, address = addrinfo
+        sock = socket.socket(family, type_, proto)
+        try:
+            sock.setblocking(False)
+            await loop.sock_connect(sock, address)
+        except:
+            sock.close()
+            raise
+        return sock
+
+    def close_late_winner(task):
+        if not task.cancelled() and task.exception() is None:
+            task.result().close()
+
+    remaining = list(candidates)
+    pending = set()
+    keys = {}
+    errors = []
+    winner = None
+
+    try:
+        while winner is None and (remaining or pending):
+            if remaining:
+                key, addrinfo = remaining.pop(0)
+                task = asyncio.ensure_future(attempt(addrinfo))
+                keys[task] = key
+                pending.add(task)
+
+            done, pending = await asyncio.wait(
+                pending,
+                timeout=delay if remaining else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in done:
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                elif winner is None:
+                    winner = task
+                else:
+                    task.result().close()
+    finally:
+        for task in pending:
+            task.cancel()
+            task.add_done_callback(close_late_winner)
+
+    if winner is None:
+        if len(errors) == 1:
+            raise errors[0]
+        raise OSError('All connection attempts failed: %s' %
+                      ', '.join(str(exc) for exc in errors))
+
+    return keys[winner], winner.result()
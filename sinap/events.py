@@ -0,0 +1,145 @@
+from collections import deque
+import asyncio
+import json
+import time
+
+
+# Live IRC events for HTTP clients. Each event is serialized once when
+# it is published, and the same bytes are written to every client
+# that wants it. Every client has a bounded buffer, and clients that
+# fall too far behind are disconnected instead of being buffered for.
+
+CHANNEL_PREFIXES = '#&+!'
+
+# IRC command -> function(args) returning (channel, fields)
+EVENT_TYPES = {
+    'PRIVMSG': lambda args: (args[0], {'text': args[-1]}),
+    'NOTICE': lambda args: (args[0], {'text': args[-1]}),
+    'JOIN': lambda args: (args[0], {}),
+    'PART': lambda args: (args[0], {'text': args[1] if len(args) > 1
+                                    else ''}),
+    'KICK': lambda args: (args[0], {'target': args[1],
+                                    'text': args[2] if len(args) > 2
+                                    else ''}),
+    'TOPIC': lambda args: (args[0], {'text': args[-1]}),
+    'MODE': lambda args: (args[0], {'text': ' '.join(args[1:])}),
+    'QUIT': lambda args: (None, {'text': args[0] if args else ''}),
+    'NICK': lambda args: (None, {'new_nick': args[0]}),
+}
+
+
+class Event(object):
+    __slots__ = ['network', 'type', 'channel', 'data', '_sse']
+
+    def __init__(self, network, type, channel, fields):
+        self.network = network
+        self.type = type
+        self.channel = channel
+        fields.update({
+            'network': network,
+            'type': type,
+            'channel': channel,
+            'time': time.time(),
+        })
+        self.data = json.dumps(fields)
+        self._sse = None
+
+    def sse(self):
+        if self._sse is None:
+            self._sse = ('data: %s\n\n' % self.data).encode('utf-8')
+        return self._sse
+
+
+def make_event(netname, message):
+    # Return an Event for an IRC message, or None if it's not one of
+    # the published events
+    make = EVENT_TYPES.get(message.command)
+    if make is None or not message.args:
+        return None
+
+    try:
+        channel, fields = make(message.args)
+    except IndexError:
+        return None
+
+    if channel is not None:
+        if channel[:1] not in CHANNEL_PREFIXES:
+            # Private messages to the bot are not published
+            return None
+        channel = channel.lower()
+
+    fields['nick'] = (message.prefix or '').split('!', 1)[0]
+    return Event(netname, message.command.lower(), channel, fields)
+
+
+class Subscriber(object):
+    def __init__(self, networks=None, channels=None, types=None,
+                 max_buffer=1000):
+        # Sets of accepted values, or None to accept all
+        self.networks = networks
+        self.channels = channels
+        self.types = types
+
+        self.max_buffer = max_buffer
+        self.buffer = deque()
+        self.overflowed = False
+        self._wakeup = asyncio.Event()
+
+    def matches(self, event):
+        return ((self.networks is None or event.network in self.networks) and
+                (self.channels is None or event.channel in self.channels) and
+                (self.types is None or event.type in self.types))
+
+    def put(self, event):
+        if len(self.buffer) >= self.max_buffer:
+            self.overflowed = True
+            self.buffer.clear()
+        else:
+            self.buffer.append(event)
+        self._wakeup.set()
+
+    async def get(self):
+        # Wait for and return the buffered events, or None if the
+        # subscriber has fallen too far behind
+        while not self.buffer and not self.overflowed:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+        if self.overflowed:
+            return None
+
+        events = list(self.buffer)
+        self.buffer.clear()
+        return events
+
+
+class EventStream(object):
+    def __init__(self, metrics):
+        self.subscribers = set()
+        metrics.gauge(
+            'sinap_event_subscribers', 'Connected event stream clients',
+        ).set_function(lambda: len(self.subscribers))
+        self.dropped = metrics.counter(
+            'sinap_event_subscribers_dropped_total',
+            'Event stream clients disconnected for falling behind',
+        )
+
+    def publish(self, netname, message):
+        if not self.subscribers:
+            return
+
+        event = make_event(netname, message)
+        if event is None:
+            return
+
+        for subscriber in self.subscribers:
+            if subscriber.matches(event):
+                subscriber.put(event)
+
+    def subscribe(self, subscriber):
+        self.subscribers.add(subscriber)
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+        if subscriber.overflowed:
+            self.dropped.inc()
@@ -8,16 +8,45 @@ import inspect
 import logging
 import re
 import socket
+import sys
+import time
+
+
+CHANNEL_PREFIXES = ('&', '#', '+', '!')
+
+
+# IRCv3 message tag value escapes
+TAG_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+
+def parse_tags(data):
+    # Parse "key=value;key2" into {'key': 'value', 'key2': ''}
+    tags = {}
+    for item in data.split(';'):
+        key, _, value = item.partition('=')
+        if '\\' in value:
+            value = re.sub(r'\\(.?)',
+                           lambda m: TAG_ESCAPES.get(m.group(1), m.group(1)),
+                           value)
+        if key:
+            tags[sys.intern(key)] = value
+    return tags
 
 
 class Message(object):
-    __slots__ = ['prefix', 'command', 'reply', 'args']
+    __slots__ = ['prefix', 'command', 'args', 'received', 'tags']
 
-    def __init__(self, prefix, command, args):
+    def __init__(self, prefix, command, args, received=None, tags=None):
         self.prefix = prefix
         self.command = command
         self.args = args
 
+        # time.monotonic() when the data was read from the socket
+        self.received = received
+
+        # IRCv3 message tags, None if the message had none
+        self.tags = tags
+
     @property
     def is_reply(self):
         return len(self.command) == 3 and self.command.isdigit()
@@ -31,6 +60,9 @@ class Message(object):
 
 
 class User(object):
+    # Users are shared by IRCConnection.parse_user(), don't modify
+    __slots__ = ['nick', 'user', 'host']
+
     def __init__(self, nick, user, host):
         self.nick = nick
         self.user = user
@@ -55,15 +87,31 @@ class Disconnected(RuntimeError):
 
 
 class IRCProtocol(asyncio.Protocol):
-    def __init__(self, message_callback, logger=None, encoding='utf-8'):
+    def __init__(self, message_callback, logger=None, encoding='utf-8',
+                 recv_buffer=b'', history=0, capture=None,
+                 batch_callback=None):
         # message_callback is called with each received message, and
-        # with None when the connection is lost.
+        # with None when the connection is lost. If batch_callback is
+        # given, it's called instead with a list of the messages
+        # received in each chunk of data.
         self._message_callback = message_callback
+        self._batch_callback = batch_callback
         self._encoding = encoding
         self.log = logger or logging.getLogger(__name__ + '.protocol')
 
         self._transport = None
-        self._recv_buffer = b''
+
+        # recv_buffer is non-empty when taking over a connection from
+        # a previous process that had received a partial line
+        self._recv_buffer = recv_buffer
+
+        # The last lines sent and received, dumped to the log when
+        # something goes wrong. Disabled if history is 0.
+        self.history = collections.deque(maxlen=history) if history else None
+
+        # A sinap.capture.CaptureWriter that records all received
+        # lines, or None
+        self._capture = capture
 
     def connection_made(self, transport):
         self.log.debug('Connection made')
@@ -71,6 +119,10 @@ class IRCProtocol(asyncio.Protocol):
 
     def connection_lost(self, exc):
         self.log.debug('Connection lost')
+        if self._capture is not None:
+            self._capture.flush()
+        if exc is not None:
+            self.dump_history('Connection lost: %s' % exc)
         self._transport = None
         self._message_callback(None)
 
@@ -78,9 +130,12 @@ class IRCProtocol(asyncio.Protocol):
         if not data:
             return
 
+        received = time.monotonic()
+
         if self._recv_buffer:
             data = self._recv_buffer + data
 
+        batch = [] if self._batch_callback is not None else None
         start = 0
         while True:
             newline_pos = data.find(b'\r\n', start)
@@ -93,31 +148,68 @@ class IRCProtocol(asyncio.Protocol):
             line = data[start:newline_pos]
             start = newline_pos + 2  # len(b'\r\n')
 
+            if self._capture is not None:
+                self._capture.write(received, line)
+
             try:
                 message = self.parse_message(line.decode(self._encoding))
             except ValueError:
-                self.log.warning('Invalid message from server: %s' % data)
+                self.log.warning('Invalid message from server: %r', line)
+                self.dump_history('Invalid message')
             else:
-                self._message_callback(message)
+                message.received = received
+                if batch is not None:
+                    batch.append(message)
+                else:
+                    self._message_callback(message)
+
+        if batch:
+            self._batch_callback(batch)
+
+    def dump_history(self, reason):
+        if not self.history:
+            return
+
+        self.log.warning('%s, last %d lines:\n%s', reason, len(self.history),
+                         '\n'.join(
+                             '%s %s %s' % (
+                                 time.strftime('%H:%M:%S', time.localtime(t)),
+                                 direction,
+                                 line,
+                             )
+                             for t, direction, line in self.history
+                         ))
 
     def parse_message(self, data):
-        self.log.debug('<<< %s' % data)
+        self.log.debug('<<< %s', data)
+        if self.history is not None:
+            self.history.append((time.time(), '<<<', data))
 
+        if data.startswith('@'):
+            part, data = data.split(' ', 1)
+            tags = parse_tags(part[1:])
+            data = data.lstrip(' ')
+        else:
+            tags = None
+
+        # Commands, prefixes and channel names repeat a lot and may be
+        # kept around, e.g. as dict keys, so share one copy of each
         if data.startswith(':'):
             # Has prefix
             part, data = data.split(' ', 1)
-            prefix = part[1:]
+            prefix = sys.intern(part[1:])
         else:
             prefix = None
 
         if ' ' not in data:
             # No args
-            return Message(prefix, data, [])
+            return Message(prefix, sys.intern(data), [], tags=tags)
 
         cmd, data = data.split(' ', 1)
+        cmd = sys.intern(cmd)
 
         if data.startswith(':'):
-            return Message(prefix, cmd, [data[1:]])
+            return Message(prefix, cmd, [data[1:]], tags=tags)
 
         if ' :' in data:
             data, trailing = data.split(' :', 1)
@@ -125,10 +217,12 @@ class IRCProtocol(asyncio.Protocol):
             trailing = None
 
         args = data.split(' ')
+        if args[0][:1] in CHANNEL_PREFIXES:
+            args[0] = sys.intern(args[0])
         if trailing:
             args.append(trailing)
 
-        return Message(prefix, cmd, args)
+        return Message(prefix, cmd, args, tags=tags)
 
     def send_message(self, command, *args, prefix=None):
         # Strip trailing Nones from args to make it easier to deal
@@ -157,7 +251,9 @@ class IRCProtocol(asyncio.Protocol):
                 data.write(last_arg)
 
         line = data.getvalue()
-        self.log.debug('>>> %s' % line)
+        self.log.debug('>>> %s', line)
+        if self.history is not None:
+            self.history.append((time.time(), '>>>', line))
         self._transport.write(line.encode('utf-8') + b'\r\n')
 
 
@@ -169,6 +265,8 @@ class IRCConnection(object):
                  realname=None,
                  logger=None,
                  delegate=None,
+                 history=0,
+                 capture=None,
                  loop=None):
         self.host = host
         self.port = port
@@ -195,49 +293,99 @@ class IRCConnection(object):
 
         self.log = logger or logging.getLogger(__name__)
         self._delegate = delegate
+        self._history = history
+        self._capture = capture
         self._loop = loop or asyncio.get_event_loop()
         self._transport = None
         self._protocol = None
 
         self._message_listeners = []
 
+        # prefix -> User, least recently used first
+        self._users = collections.OrderedDict()
+        self._max_users = 1024
+
+        # The message whose handler is currently running
+        self.current_message = None
+
         self._send_queue = collections.deque()
         self._send_burst_decrementer = None
         self._current_send_burst = 0
         self._max_send_burst = 3
         self._send_burst_wait = 2.0
 
+        # PRIVMSGs and NOTICEs identical to one still in the send
+        # queue or sent less than dedup_window seconds ago are
+        # dropped. Disabled if 0.
+        self._dedup_window = 0
+        self._dedup_size = 1024
+
+        # (command, target, text) of the messages in the send queue
+        self._queued_keys = set()
+
+        # (command, target, text) -> time.monotonic() when last sent,
+        # least recently used first
+        self._recent_sends = collections.OrderedDict()
+
+        # Handlers scheduled but not yet finished, and work they have
+        # started with track_work(). Reading from the server is paused
+        # when there are high_water of them, and resumed when there
+        # are low_water left, or after max_pause seconds so that the
+        # server's PINGs are answered even if a handler hangs. A
+        # high_water of 0 disables pausing.
+        self._outstanding = 0
+        self._high_water = 1000
+        self._low_water = 100
+        self._max_pause = 30.0
+        self._paused_at = None
+        self._pause_timeout = None
+
+        # Call the handlers of all messages received in one chunk of
+        # data in a single callback, see call_batch()
+        self._batch_dispatch = False
+
         self._connect_future = None
         self._disconnect_future = None
 
-    async def connect(self, reuse_fd=None):
+    async def connect(self, reuse_fd=None, family=socket.AF_INET,
+                      recv_buffer=b''):
         # If reuse_fd is given, it should be a connected file
-        # descriptor number
+        # descriptor number of the given address family. recv_buffer
+        # is the partial line that was left unprocessed by the
+        # previous owner of the fd.
         if reuse_fd is None:
-            connect_kwds = {
-                'host': self.host,
-                'port': self.port,
-                'ssl': self.ssl,
-            }
+            connect_kwds = await self.connect_args()
         else:
-            self.log.debug('Reusing fd %d' % reuse_fd)
-            sock = socket.fromfd(reuse_fd, socket.AF_INET, socket.SOCK_STREAM)
+            self.log.debug('Reusing fd %d', reuse_fd)
+            sock = socket.socket(family, socket.SOCK_STREAM, fileno=reuse_fd)
             connect_kwds = {'sock': sock}
 
         self._transport, self._protocol = await self._loop.create_connection(
-            lambda: IRCProtocol(self.process_message, self.log),
+            lambda: IRCProtocol(self.process_message, self.log,
+                                recv_buffer=recv_buffer,
+                                history=self._history,
+                                capture=self._capture,
+                                batch_callback=(self.process_batch
+                                                if self._batch_dispatch
+                                                else None)),
             **connect_kwds,
         )
 
         self.start_send_burst_decrementer()
 
-        if reuse_fd:
+        if reuse_fd is not None:
             # Already registered
             self._disconnect_future = asyncio.Future()
             return
 
-        # This is a new connection, register with the server
-        # asynchronously
+        # This is a new connection. Anything queued for the old one
+        # would be sent before registration, and the old connection's
+        # burst doesn't count against this one.
+        self._send_queue.clear()
+        self._queued_keys.clear()
+        self._current_send_burst = 0
+
+        # Register with the server asynchronously
         self._connect_future = asyncio.Future()
         self.register()
 
@@ -250,6 +398,15 @@ class IRCConnection(object):
         self._connect_future = None
         self._disconnect_future = asyncio.Future()
 
+    async def connect_args(self):
+        # Return keyword arguments for loop.create_connection(). May
+        # be overridden to establish the connection differently.
+        return {
+            'host': self.host,
+            'port': self.port,
+            'ssl': self.ssl,
+        }
+
     def register(self):
         self.log.debug('Registering connection')
 
@@ -273,6 +430,30 @@ class IRCConnection(object):
 
         await self._disconnect_future
 
+    def dump_buffers(self):
+        # Return the connection's in-flight data in a form that can be
+        # handed over to another process with load_buffers()
+        return {
+            'recv_buffer': self._protocol._recv_buffer if self._protocol else b'',
+            'send_queue': [
+                [command, list(args), prefix]
+                for command, args, prefix, queued_at, trace in self._send_queue
+            ],
+            'send_burst': self._current_send_burst,
+        }
+
+    def load_buffers(self, state):
+        # Call after connect(). The receive buffer must be passed to
+        # connect() because data may arrive as soon as the transport
+        # is created.
+        self._current_send_burst = state.get('send_burst', 0)
+        now = time.monotonic()
+        for command, args, prefix in state.get('send_queue', []):
+            self._send_queue.append([command, tuple(args), prefix, now, None])
+
+        if self._send_queue:
+            self._loop.call_soon(self.send_pending_messages)
+
     def process_message(self, msg):
         if msg is None:
             exc = Disconnected()
@@ -290,45 +471,248 @@ class IRCConnection(object):
             del self._message_listeners[:]
 
             self.stop_send_burst_decrementer()
+            self.resume_reading()
             return
 
+        self.message_received(msg)
+
+        for _, handler in self.handlers('handle_message'):
+            self.schedule_handler(msg, handler, msg)
+
+        for _, handler in self.handlers(self.type_handler_name(msg)):
+            self.schedule_handler(msg, handler, msg)
+
+        # Call the command specific handler if any
+        for handler_name, handler in self.handlers_for_msg(msg):
+            args = self.handler_args(handler_name, handler, msg)
+            if args is not None:
+                self.schedule_handler(msg, handler, *args)
+
+    def process_batch(self, messages):
+        # Like process_message(), but for all messages received in one
+        # chunk of data. The handlers are called in one callback.
+        for msg in messages:
+            self.message_received(msg)
+
+        self.work_started(len(messages))
+        self._loop.call_soon(self.call_batch, messages)
+
+    def message_received(self, msg):
+        # Things that are done immediately when a message is received,
+        # before its handlers are called
+        if msg.command == 'PING':
+            # Answer right away instead of queueing behind the
+            # handlers and other outgoing messages, so that the server
+            # doesn't drop a busy connection
+            self.send_now('PONG', *msg.args)
+
         for future in self._message_listeners:
             future.set_result(msg)
         del self._message_listeners[:]
 
-        for _, handler in self.handlers('handle_message'):
-            self._loop.call_soon(handler, msg)
-
+    def type_handler_name(self, msg):
         if msg.is_command:
-            type_handler_name = 'handle_command'
+            return 'handle_command'
         else:
-            type_handler_name = 'handle_reply'
-
-        for _, handler in self.handlers(type_handler_name):
-            self._loop.call_soon(partial(handler, msg))
+            return 'handle_reply'
 
-        # Call the command specific handler if any
-        for handler_name, handler in self.handlers_for_msg(msg):
-            sig = inspect.signature(handler)
-            try:
-                sig.bind(msg.prefix, *msg.args)
-            except TypeError:
-                self.log.warning('''\
+    def handler_args(self, handler_name, handler, msg):
+        # Return the arguments to call a command specific handler
+        # with, or None if its signature doesn't match the message
+        sig = inspect.signature(handler)
+        try:
+            sig.bind(msg.prefix, *msg.args)
+        except TypeError:
+            self.log.warning('''\
 Command handler signature does not match the command sent by server.
 Singature: %s%s
 Command: %s''' % (handler_name, sig, msg))
-            else:
-                self._loop.call_soon(partial(handler, msg.prefix, *msg.args))
+            return None
+        return (msg.prefix,) + tuple(msg.args)
+
+    def call_batch(self, messages):
+        # Handlers that have a batch variant, e.g. on_353_batch() or
+        # handle_message_batch(), are called once with the list of
+        # the messages they would handle. The rest are called for
+        # each message in turn. An error in one handler doesn't
+        # prevent calling the others.
+        groups = collections.OrderedDict()
+        for msg in messages:
+            for handler_name in ('handle_message',
+                                 self.type_handler_name(msg),
+                                 'on_%s' % msg.command.lower()):
+                groups.setdefault(handler_name, []).append(msg)
 
-    def send_message(self, command, *args, prefix=None):
-        self._send_queue.append([command, args, prefix])
+        try:
+            # handler name -> handlers to call for each message
+            single = {}
+            for handler_name, group in groups.items():
+                single[handler_name] = []
+                for handler, batched in self.handlers_batched(handler_name):
+                    if batched:
+                        self.call_safely(None, handler, group)
+                    else:
+                        single[handler_name].append(handler)
+
+            for msg in messages:
+                for handler in single['handle_message']:
+                    self.call_safely(msg, handler, msg)
+                for handler in single[self.type_handler_name(msg)]:
+                    self.call_safely(msg, handler, msg)
+
+                handler_name = 'on_%s' % msg.command.lower()
+                for handler in single[handler_name]:
+                    args = self.handler_args(handler_name, handler, msg)
+                    if args is not None:
+                        self.call_safely(msg, handler, *args)
+        finally:
+            self.work_finished(len(messages))
+
+    def call_safely(self, msg, handler, *args):
+        self.current_message = msg
+        try:
+            handler(*args)
+        except Exception:
+            self.log.exception('Error in handler %r', handler)
+        finally:
+            self.current_message = None
+
+    def schedule_handler(self, msg, handler, *args):
+        self.work_started()
+        self._loop.call_soon(self.call_handler, msg, handler, *args)
+
+    def call_handler(self, msg, handler, *args):
+        # Handlers can look at current_message to get at the message
+        # being handled, e.g. to find out when it was received
+        self.current_message = msg
+        try:
+            handler(*args)
+        finally:
+            self.current_message = None
+            self.work_finished()
+
+    def track_work(self, done=None):
+        # Count work done on behalf of this connection, e.g. a task
+        # started by a handler, as outstanding until the returned
+        # function is called. Its arguments are passed on to done.
+        self.work_started()
+
+        def finished(*args):
+            self.work_finished()
+            if done is not None:
+                done(*args)
+
+        return finished
+
+    def work_started(self, count=1):
+        self._outstanding += count
+        if self._high_water and self._outstanding >= self._high_water:
+            self.pause_reading()
+
+    def work_finished(self, count=1):
+        self._outstanding -= count
+        if self._outstanding <= self._low_water:
+            self.resume_reading()
+
+    def pause_reading(self):
+        if self._paused_at is not None or not self._transport:
+            return
+
+        self.log.info('Handlers are falling behind, pausing reading')
+        self._transport.pause_reading()
+        self._paused_at = time.monotonic()
+        self._pause_timeout = self._loop.call_later(
+            self._max_pause, self.resume_reading,
+        )
+
+    def resume_reading(self):
+        if self._paused_at is None:
+            return
+
+        duration = time.monotonic() - self._paused_at
+        self._paused_at = None
+        self._pause_timeout.cancel()
+        self._pause_timeout = None
+        if self._transport and not self._transport.is_closing():
+            self.log.info('Resuming reading after %.3f seconds', duration)
+            self._transport.resume_reading()
+        self.reading_resumed(duration)
+
+    def reading_resumed(self, duration):
+        # Called when reading from the server is resumed after being
+        # paused for duration seconds
+        pass
+
+    def send_message(self, command, *args, prefix=None, trace=None):
+        # trace is passed back to message_sent() when the message is
+        # actually sent
+        if self._dedup_window and self.is_duplicate(command, args):
+            self.message_suppressed(command, args)
+            return
+
+        self._send_queue.append([command, args, prefix, time.monotonic(), trace])
         self._loop.call_soon(self.send_pending_messages)
 
+    def dedup_key(self, command, args):
+        if command in ('PRIVMSG', 'NOTICE') and len(args) == 2:
+            return command, args[0].lower(), args[1]
+        return None
+
+    def is_duplicate(self, command, args):
+        # If not a duplicate, the message is taken to be queued
+        key = self.dedup_key(command, args)
+        if key is None:
+            return False
+
+        if key in self._queued_keys:
+            return True
+
+        last = self._recent_sends.get(key)
+        if last is not None and time.monotonic() - last < self._dedup_window:
+            return True
+
+        self._queued_keys.add(key)
+        return False
+
+    def dedup_sent(self, command, args):
+        key = self.dedup_key(command, args)
+        if key is None:
+            return
+
+        self._queued_keys.discard(key)
+        self._recent_sends[key] = time.monotonic()
+        self._recent_sends.move_to_end(key)
+        if len(self._recent_sends) > self._dedup_size:
+            self._recent_sends.popitem(last=False)
+
+    def message_suppressed(self, command, args):
+        # Called when a message is dropped as a duplicate
+        pass
+
+    def send_now(self, command, *args):
+        # Send a message bypassing the send queue and flood
+        # protection. Only for short messages that can't wait.
+        self._protocol.send_message(command, *args)
+        self.message_sent(command, args, time.monotonic(), None)
+
+    def pending_sends(self):
+        # Number of messages waiting for the flood protection
+        return len(self._send_queue)
+
     def send_pending_messages(self):
         while self._send_queue and self._current_send_burst < self._max_send_burst:
-            command, args, prefix = self._send_queue.popleft()
+            command, args, prefix, queued_at, trace = self._send_queue.popleft()
             self._protocol.send_message(command, *args, prefix=prefix)
             self._current_send_burst += 1
+            if self._dedup_window:
+                self.dedup_sent(command, args)
+            self.message_sent(command, args, queued_at, trace)
+
+    def message_sent(self, command, args, queued_at, trace):
+        # Called after a message has been written to the transport.
+        # queued_at is the time.monotonic() when the message was
+        # queued.
+        pass
 
     def start_send_burst_decrementer(self):
         self._send_burst_decrementer = self._loop.call_later(
@@ -355,6 +739,21 @@ Command: %s''' % (handler_name, sig, msg))
             handler = getattr(self._delegate, handler_name)
             yield handler_name, partial(handler, self)
 
+    def handlers_batched(self, handler_name):
+        # Like handlers(), but yield (handler, batched) pairs. batched
+        # is True if the object has a handler_name + '_batch' handler,
+        # which is then yielded instead of handler_name.
+        for obj, args in ((self, ()), (self._delegate, (self,))):
+            if obj is None:
+                continue
+
+            handler = getattr(obj, handler_name + '_batch', None)
+            batched = handler is not None
+            if not batched:
+                handler = getattr(obj, handler_name, None)
+            if handler is not None:
+                yield (partial(handler, *args) if args else handler), batched
+
     def handlers_for_msg(self, msg):
         handler_name = 'on_%s' % msg.command.lower()
         return self.handlers(handler_name)
@@ -362,12 +761,26 @@ Command: %s''' % (handler_name, sig, msg))
     USER_RE = re.compile('^(?P<nick>[^!]+)(!(?P<user>[^@]+)@(?P<host>.*))?$')
 
     def parse_user(self, text):
+        # The same users talk over and over, so keep the most recent
+        # ones parsed
+        user = self._users.get(text)
+        if user is not None:
+            self._users.move_to_end(text)
+            return user
+
         match = self.USER_RE.match(text)
         if match:
-            return User(*(match.group(x) for x in ('nick', 'user', 'host')))
+            user = User(*(
+                sys.intern(value) if value is not None else None
+                for value in match.group('nick', 'user', 'host')
+            ))
+            self._users[text] = user
+            if len(self._users) > self._max_users:
+                self._users.popitem(last=False)
+            return user
 
     def is_channel(self, name):
-        return name.startswith(('&', '#', '+', '!'))
+        return name.startswith(CHANNEL_PREFIXES)
 
     def is_safe_channel(self, name):
         return name.startswith(self.safe_channel_prefix)
@@ -407,8 +820,8 @@ Command: %s''' % (handler_name, sig, msg))
     def part(self, channel, message=None):
         return self.send_message('PART', channel, message)
 
-    def privmsg(self, target, message):
-        return self.send_message('PRIVMSG', target, message)
+    def privmsg(self, target, message, trace=None):
+        return self.send_message('PRIVMSG', target, message, trace=trace)
 
     # Generic message handlers
 
@@ -433,8 +846,8 @@ Command: %s''' % (handler_name, sig, msg))
 
     # Example:
     #
-    # def on_ping(self, prefix, *args):
-    #     self.send_message('PONG', *args)
+    # def on_invite(self, prefix, nick, channel):
+    #     self.join(channel)
 
     def on_001(self, prefix, *args):
         # RPL_WELCOME
@@ -452,12 +865,12 @@ Command: %s''' % (handler_name, sig, msg))
     def on_nick(self, prefix, new_nick):
         user = self.parse_user(prefix)
         if user and user.nick == self.nick:
-            self.log.debug('Nick changed to %s' % new_nick)
+            self.log.debug('Nick changed to %s', new_nick)
             self.nick = new_nick
 
     def on_join(self, prefix, channel):
         user = self.parse_user(prefix)
         if user and user.nick == self.nick:
-            self.log.debug('Joined channel %s' % channel)
+            self.log.debug('Joined channel %s', channel)
             short_name, long_name = self.parse_channel_name(channel)
-            self.channels[short_name] = long_name
+            self.channels[sys.intern(short_name)] = sys.intern(long_name)
@@ -0,0 +1,255 @@
+from bisect import bisect_left
+import json
+
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def escape_label(value):
+    return (str(value)
+            .replace('\\', '\\\\')
+            .replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, escape_label(value)) for name, value in labels
+    )
+
+
+class CounterValue(object):
+    __slots__ = ['value']
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class GaugeValue(object):
+    __slots__ = ['value', 'function']
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, function):
+        # Read the value by calling function when collected
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class HistogramValue(object):
+    __slots__ = ['buckets', 'counts', 'sum', 'count']
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metric(object):
+    # A metric family. Values are looked up by label values with
+    # labels(), metrics without labels can be used directly.
+
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def new_value(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        value = self._values.get(values)
+        if value is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('%s expects labels %s' %
+                                 (self.name, self.labelnames))
+            value = self._values[values] = self.new_value()
+        return value
+
+    def remove(self, *values):
+        self._values.pop(values, None)
+
+    def samples(self):
+        for values, value in sorted(self._values.items()):
+            yield list(zip(self.labelnames, values)), value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def new_value(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def new_value(self):
+        return GaugeValue()
+
+    def set(self, value):
+        self._default.set(value)
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+    def set_function(self, function):
+        self._default.set_function(function)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames)
+
+    def new_value(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+
+class Registry(object):
+    def __init__(self):
+        # name -> Metric
+        self.metrics = {}
+
+    def _get_or_create(self, cls, name, help, labelnames, **kwds):
+        # Return the existing metric if there is one, so that modules
+        # can (re)create their metrics in startup after a reload
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, help, labelnames, **kwds)
+        elif not isinstance(metric, cls):
+            raise ValueError('Metric %s already registered as a %s' %
+                             (name, metric.type))
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._get_or_create(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get_or_create(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, help, labelnames,
+                                   buckets=buckets)
+
+    def render_prometheus(self):
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append('# HELP %s %s' % (name, metric.help))
+            lines.append('# TYPE %s %s' % (name, metric.type))
+
+            for labels, value in metric.samples():
+                if metric.type == 'histogram':
+                    for bound, count in value.cumulative():
+                        bucket_labels = labels + [('le', format_value(bound))]
+                        lines.append('%s_bucket%s %d' % (
+                            name, format_labels(bucket_labels), count,
+                        ))
+                    lines.append('%s_sum%s %s' % (
+                        name, format_labels(labels), format_value(value.sum),
+                    ))
+                    lines.append('%s_count%s %d' % (
+                        name, format_labels(labels), value.count,
+                    ))
+                elif metric.type == 'gauge':
+                    lines.append('%s%s %s' % (
+                        name, format_labels(labels), format_value(value.get()),
+                    ))
+                else:
+                    lines.append('%s%s %s' % (
+                        name, format_labels(labels), format_value(value.value),
+                    ))
+
+        return '\n'.join(lines) + '\n'
+
+    def as_dict(self):
+        result = {}
+        for name, metric in sorted(self.metrics.items()):
+            samples = []
+            for labels, value in metric.samples():
+                if metric.type == 'histogram':
+                    sample_value = {
+                        'buckets': [
+                            [format_value(bound), count]
+                            for bound, count in value.cumulative()
+                        ],
+                        'sum': value.sum,
+                        'count': value.count,
+                    }
+                elif metric.type == 'gauge':
+                    sample_value = value.get()
+                else:
+                    sample_value = value.value
+                samples.append({'labels': dict(labels), 'value': sample_value})
+
+            result[name] = {
+                'type': metric.type,
+                'help': metric.help,
+                'samples': samples,
+            }
+        return result
+
+    def render_json(self):
+        return json.dumps(self.as_dict())
@@ -6,6 +6,11 @@ import subprocess
 from sinap.scope import Scope
 
 
+# Lines say_lines() says before using a paste when there's no paste
+# module
+DEFAULT_LINE_BUDGET = 5
+
+
 class Module(object):
     # Override in modules for custom startup and shutdown
 
@@ -15,9 +20,44 @@ class Module(object):
     def shutdown(self):
         pass
 
+    # Override to hand state over to the new process when the bot
+    # restarts, e.g. file descriptors to keep open. Return something
+    # that can be saved as YAML, or None.
+    def dump_state(self):
+        return None
+
+    # The state this module dumped before the bot restarted, or None.
+    # Returns it only once, a module reloaded later gets None.
+    def take_restart_state(self):
+        return self.bot.state.get('modules', {}).pop(self.qualified_name,
+                                                      None)
+
     # Usage: self.say(scope, 'Hello, World!')
     def say(self, scope, message):
-        return scope.net.privmsg(scope.target, message)
+        if scope.recorder is not None:
+            scope.recorder.append(message)
+        return scope.net.privmsg(scope.target, message, trace=scope.trace)
+
+    # Say lines, or if there are more than the paste module's
+    # line_budget, the first line and a link to all of them.
+    # Usage: self.say_lines(scope, ['line 1', 'line 2', ...])
+    def say_lines(self, scope, lines, title=None):
+        paste = self.bot.exports.get('paste')
+        budget = paste.line_budget if paste else DEFAULT_LINE_BUDGET
+        if len(lines) <= budget:
+            for line in lines:
+                self.say(scope, line)
+            return
+
+        url = paste.create('\n'.join(lines), title) if paste else None
+        if url:
+            self.say(scope, '%s [%d more lines: %s]' % (
+                lines[0], len(lines) - 1, url,
+            ))
+        else:
+            for line in lines[:budget - 1]:
+                self.say(scope, line)
+            self.say(scope, '[%d more lines]' % (len(lines) - budget + 1))
 
     # Usage: self.say_to('network_name', '#channel', 'Hello, World!')
     # Usage: self.say_to('network_name', 'nick', 'Hello, World!')
@@ -25,12 +65,19 @@ class Module(object):
         return self.say(self.make_scope(network_name, target), message)
 
     def make_scope(self, network_name, target):
-        network = self.bot.networks.get(network_name)
+        network = self.bot.get_network(network_name)
         if network is None:
             raise ValueError('No such network: %s' % network_name)
 
         return Scope(network, None, target, raw=True)
 
+    # Persistent storage for this module, see sinap.storage
+    # Usage: self.store.set('key', value)
+    # Usage: self.store.table('karma').get(nick)
+    @property
+    def store(self):
+        return self.bot.storage.namespace(self.qualified_name)
+
     # Usage: await self.wait(2.5)
     def wait(self, seconds):
         future = asyncio.Future()
@@ -84,6 +131,9 @@ class Module(object):
 
     # Internals
 
+    # Set by the bot after construction, e.g. 'core:commands'
+    qualified_name = None
+
     def __init__(self, bot, config, logger):
         self.bot = bot
         self.loop = bot.loop
@@ -100,6 +150,7 @@ class Module(object):
     def _shutdown(self):
         self._cancel_timeouts()
         self.shutdown()
+        self.bot.storage.flush()
 
     def _cancel_timeouts(self):
         for handle in self._timeouts:
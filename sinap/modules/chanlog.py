@@ -0,0 +1,261 @@
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+import time
+
+from sinap.chanlog import ChannelLogStore
+from sinap.module import Module
+
+
+# Logs channel messages to datadir/chanlog/<network>/<channel> and
+# answers searches over them. Messages are buffered and written, and
+# searches run, in a background thread. See sinap.chanlog for the file
+# format.
+#
+# Configuration:
+#
+#   modulesets:
+#     core:
+#       chanlog:
+#         enabled: true
+#         channels: ['#sinap']     # optional, default all channels
+#         flush_interval: 5
+#         max_results: 20
+
+def format_ago(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return 'just now'
+
+    parts = []
+    for unit, size in (('d', 86400), ('h', 3600), ('m', 60)):
+        if seconds >= size:
+            parts.append('%d%s' % (seconds // size, unit))
+            seconds %= size
+    return ' '.join(parts[:2]) + ' ago'
+
+
+def format_record(record):
+    timestamp, nick, text = record
+    return '[%s] <%s> %s' % (
+        time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp)), nick, text,
+    )
+
+
+class ChanlogModule(Module):
+    public_commands = {
+        'grep': {
+            'nargs': ':',
+            'synopsis': 'grep [<channel>] <words>',
+            'help': 'Search the channel log for lines with all the words',
+        },
+        'seen': {
+            'nargs': 1,
+            'synopsis': 'seen <nick>',
+            'help': 'Tell when a nick was last seen on this channel',
+        },
+        'last': {
+            'nargs': (0, 2),
+            'synopsis': 'last [<channel>] [<count>]',
+            'help': 'Show the most recent lines of the channel log, at '
+                    'most 100',
+        },
+    }
+
+    def __init__(self, *args, **kwds):
+        super().__init__(*args, **kwds)
+
+        self.enabled = bool(self.config.get('enabled') and self.bot.datadir)
+        if not self.enabled:
+            self.public_commands = {}
+            return
+
+        channels = self.config.get('channels')
+        self.channels = set(c.lower() for c in channels) if channels else None
+        self.flush_interval = self.config.get('flush_interval', 5)
+        self.max_results = self.config.get('max_results', 20)
+        self.directory = self.bot.datadir / 'chanlog'
+
+        # (network, channel) -> [(time, nick, text)] not yet written
+        self._buffer = {}
+
+        # (network, channel) -> ChannelLogStore, only used in the
+        # executor thread
+        self._stores = {}
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def startup(self):
+        if self.enabled:
+            self.call_later(self.flush_interval, self._flush_periodically)
+
+    def shutdown(self):
+        if self.enabled:
+            self._flush()
+            # Wait for the writes, the next instance of the module
+            # will use the same files
+            self._executor.shutdown(wait=True)
+
+    def on_irc_message(self, net, message):
+        if not self.enabled or not message.args:
+            return
+
+        command = message.command
+        nick = (message.prefix or '').split('!', 1)[0]
+        channel = message.args[0]
+        if command in ('PRIVMSG', 'NOTICE'):
+            if not net.is_channel(channel):
+                # Private messages are not logged
+                return
+
+            text = message.args[-1]
+            if text.startswith('\x01ACTION ') and text.endswith('\x01'):
+                text = '* %s %s' % (nick, text[8:-1])
+            self._log(net.name, channel, nick, text)
+            self._seen(net.name, nick, channel, 'saying: %s' % text)
+        elif command == 'JOIN':
+            self._seen(net.name, nick, channel, 'joining')
+        elif command == 'PART':
+            self._seen(net.name, nick, channel, 'leaving')
+        elif command == 'QUIT':
+            self._seen(net.name, nick, None, 'quitting')
+        elif command == 'NICK':
+            self._seen(net.name, nick, None,
+                       'changing nick to %s' % message.args[0])
+
+    def _wanted(self, channel):
+        return self.channels is None or channel.lower() in self.channels
+
+    def _log(self, network, channel, nick, text):
+        if not self._wanted(channel):
+            return
+
+        buffer = self._buffer.setdefault((network, channel.lower()), [])
+        buffer.append((time.time(), nick, text))
+        if len(buffer) >= 1000:
+            self._flush()
+
+    def _seen(self, network, nick, channel, what):
+        if channel is not None and not self._wanted(channel):
+            return
+
+        # The last sighting on the whole network is only shown to
+        # admins, others see the last one on their own channel. Writes
+        # are batched by the storage.
+        seen = {
+            'nick': nick,
+            'time': time.time(),
+            'channel': channel,
+            'what': what,
+        }
+        self.store.table('seen:%s' % network).set(nick.lower(), seen)
+        if channel is not None:
+            self.store.table('seen:%s:%s' % (network, channel.lower())).set(
+                nick.lower(), seen,
+            )
+
+    def _flush(self):
+        buffer, self._buffer = self._buffer, {}
+        for key, records in buffer.items():
+            self._executor.submit(self._append, key, records)
+
+    def _flush_periodically(self):
+        self._flush()
+        self.call_later(self.flush_interval, self._flush_periodically)
+
+    def _store(self, key):
+        store = self._stores.get(key)
+        if store is None:
+            network, channel = key
+            store = self._stores[key] = ChannelLogStore(
+                self.directory / quote(network, safe='') /
+                quote(channel, safe='')
+            )
+        return store
+
+    # Run in the executor thread
+
+    def _append(self, key, records):
+        try:
+            self._store(key).append(records)
+        except Exception:
+            self.log.exception('Unable to write the log of %s/%s' % key)
+
+    # Commands
+
+    def _channel_args(self, scope, args):
+        # Split an optional leading channel off args, which defaults
+        # to the current channel. Only admins may read the logs of
+        # other channels.
+        first, _, rest = args.partition(' ')
+        if scope.net.is_channel(first):
+            if (self.bot.is_admin(scope.user) or
+                    scope.channel_matches(first)):
+                return first, rest.strip()
+            return None, args
+        if scope.net.is_channel(scope.target):
+            return scope.target, args
+        return None, args
+
+    async def _run(self, func, *args):
+        # Write what's buffered first, so that the results include the
+        # latest lines
+        self._flush()
+        return await self.loop.run_in_executor(self._executor, func, *args)
+
+    async def command_grep(self, user, scope, args):
+        channel, query = self._channel_args(scope, args)
+        if channel is None:
+            self.say(scope, 'Give a channel you can read')
+            return
+
+        key = (scope.net.name, channel.lower())
+        records = await self._run(
+            lambda: self._store(key).search(query, self.max_results,
+                                            self.bot.command_prefix)
+        )
+        if not records:
+            self.say(scope, 'No matches')
+            return
+
+        self.say_lines(scope, [format_record(record) for record in records],
+                       title='Search results for %r on %s' % (query, channel))
+
+    async def command_last(self, user, scope, *args):
+        channel, count = self._channel_args(scope, ' '.join(args))
+        if channel is None:
+            self.say(scope, 'Give a channel you can read')
+            return
+
+        try:
+            count = min(max(int(count or 5), 1), 100)
+        except ValueError:
+            self.say(scope, 'Invalid count: %s' % count)
+            return
+
+        key = (scope.net.name, channel.lower())
+        records = await self._run(lambda: self._store(key).last(count))
+        if not records:
+            self.say(scope, 'Nothing logged on %s' % channel)
+            return
+
+        self.say_lines(scope, [format_record(record) for record in records],
+                       title='Last lines on %s' % channel)
+
+    def command_seen(self, user, scope, nick):
+        if self.bot.is_admin(user):
+            table = 'seen:%s' % scope.net.name
+        elif scope.net.is_channel(scope.target):
+            table = 'seen:%s:%s' % (scope.net.name, scope.target.lower())
+        else:
+            self.say(scope, 'Ask on a channel')
+            return
+
+        seen = self.store.table(table).get(nick.lower())
+        if seen is None:
+            self.say(scope, "I haven't seen %s" % nick)
+            return
+
+        where = ' on %s' % seen['channel'] if seen['channel'] else ''
+        self.say(scope, '%s was last seen %s%s, %s' % (
+            seen['nick'], format_ago(time.time() - seen['time']), where,
+            seen['what'],
+        ))
@@ -1,4 +1,9 @@
+import threading
+import time
+
 from sinap.module import Module
+from sinap.profiler import MemoryProfiler, SamplingProfiler
+from sinap.trace import STAGES
 
 
 class CommandsModule(Module):
@@ -6,6 +11,18 @@ class CommandsModule(Module):
         'reload': 'Reload configuration and modules',
         'restart': 'Restart the bot without disconnecting from networks',
         'networks': 'List networks',
+        'reconnects': 'Show reconnect statistics',
+        'profile': {
+            'nargs': (1, 2),
+            'synopsis': 'profile cpu|mem [<seconds>]',
+            'help': 'Profile CPU usage or memory allocations for a while '
+                    '(default 10 seconds)',
+        },
+        'traces': {
+            'nargs': (0, 1),
+            'synopsis': 'traces [<count>]',
+            'help': 'Show the most recent slow replies, at most 10',
+        },
         'join': {
             'nargs': 2,
             'synopsis': 'join <channel> <network>',
@@ -26,8 +43,10 @@ class CommandsModule(Module):
         },
     }
 
+    _profiling = False
+
     def command_reload(self, user, scope):
-        self.bot.reload()
+        self.bot.request_reload()
         self.say(scope, 'Reload OK')
 
     def command_restart(self, user, scope):
@@ -36,13 +55,120 @@ class CommandsModule(Module):
             self.bot.restart()
         except ValueError as exc:
             self.say(scope, str(exc))
+        except Exception as exc:
+            self.log.exception('Restart failed')
+            self.say(scope, 'Restart failed: %s' % exc)
 
     def command_networks(self, user, scope):
-        names = ', '.join(sorted(self.bot.networks.keys()))
+        names = ', '.join(sorted(
+            list(self.bot.networks.keys()) +
+            list(self.bot.remote_networks.keys())
+        ))
         self.say(scope, 'My networks: %s' % names)
 
+    def command_reconnects(self, user, scope):
+        stats = self.bot.reconnects.stats
+        if not stats:
+            self.say(scope, 'No reconnects')
+            return
+
+        for netname, net_stats in sorted(stats.items()):
+            self.say(scope, '%s: %d reconnects, %d failed attempts, '
+                     'last took %.1fs, total %.1fs' % (
+                         netname,
+                         net_stats['reconnects'],
+                         net_stats['failures'],
+                         net_stats['last_duration'],
+                         net_stats['total_duration'],
+                     ))
+
+    def command_traces(self, user, scope, count='3'):
+        try:
+            count = min(max(int(count), 1), 10)
+        except ValueError:
+            self.say(scope, 'Invalid count: %s' % count)
+            return
+
+        traces = list(self.bot.tracer.slow)[-count:]
+        if not traces:
+            self.say(scope, 'No slow replies')
+            return
+
+        for trace in traces:
+            self.say(scope, '%s (%s) on %s took %.2fs: %s' % (
+                trace['command'],
+                trace['module'],
+                trace['network'],
+                trace['total'],
+                ', '.join(
+                    '%s %.2fs' % (stage, trace['stages'][stage])
+                    for stage in STAGES
+                ),
+            ))
+
+    async def command_profile(self, user, scope, kind, seconds='10'):
+        if kind not in ('cpu', 'mem'):
+            self.say(scope, 'Unknown profile type: %s' % kind)
+            return
+
+        if not seconds.isdigit() or not 1 <= int(seconds) <= 300:
+            self.say(scope, 'Seconds must be between 1 and 300')
+            return
+
+        if self._profiling:
+            self.say(scope, 'A profile is already running')
+            return
+
+        seconds = int(seconds)
+        self._profiling = True
+        self.say(scope, 'Profiling %s for %d seconds' % (kind, seconds))
+        try:
+            if kind == 'cpu':
+                profiler = SamplingProfiler(threading.get_ident())
+                await self.loop.run_in_executor(None, profiler.run, seconds)
+                summary = '%d samples, top: %s' % (profiler.samples, ', '.join(
+                    '%s %.1f%%' % item for item in profiler.top(3)
+                ))
+            else:
+                profiler = MemoryProfiler()
+                profiler.start()
+                await self.wait(seconds)
+                await self.loop.run_in_executor(None, profiler.stop)
+                summary = 'Top growth: %s' % ', '.join(
+                    '%s %+d KiB' % (site, size // 1024)
+                    for site, size in profiler.top(3)
+                )
+        finally:
+            self._profiling = False
+
+        self.say(scope, summary)
+
+        url = self._save_profile(kind, profiler.report())
+        if url:
+            self.say(scope, 'Full report: %s' % url)
+
+    def _save_profile(self, kind, report):
+        # Write the report to datadir and return its URL if the HTTP
+        # module serves profiles. The path is only logged, it's no
+        # business of the channel.
+        if not self.bot.datadir:
+            return None
+
+        directory = self.bot.datadir / 'profiles'
+        if not directory.exists():
+            directory.mkdir()
+
+        name = '%s-%s.txt' % (kind, time.strftime('%Y%m%d-%H%M%S'))
+        (directory / name).write_text(report)
+
+        http = self.bot.exports.get('http')
+        if http and http.config.get('profiles', False):
+            return http.reverse_url('profile', name=name)
+        self.log.info('Profile saved to %s' % (directory / name))
+        return None
+
     def _check_channel_and_net(self, scope, channel, network):
-        net = self.bot.networks.get(network, None)
+        net = self.bot.get_network(network)
         if not net:
             self.say(scope, 'Uknown network: %s' % net)
             return
@@ -75,7 +201,18 @@ class CommandsModule(Module):
         if command is None:
             if commands:
                 names = ', '.join(sorted(commands.keys()))
-                self.say(scope, 'Available commands: %s' % names)
+                lines = ['Available commands: %s' % names]
+                paste = self.bot.exports.get('paste')
+                if paste and paste.available:
+                    # Usually too long to say, but fine to link to
+                    for name, cmd in sorted(commands.items()):
+                        if name in cmd['aliases']:
+                            continue
+                        line = self.bot.command_prefix + cmd['synopsis']
+                        if cmd['help']:
+                            line += ' - ' + cmd['help']
+                        lines.append(line)
+                self.say_lines(scope, lines, title='Commands')
             else:
                 self.say(scope, 'No commands available for you, sorry')
         else:
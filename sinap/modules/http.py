@@ -1,4 +1,12 @@
-from aiohttp.web import Application
+import asyncio
+import json
+import os
+import socket
+
+from aiohttp.web import (
+    Application, HTTPNotFound, Response, StreamResponse, WebSocketResponse,
+)
+from sinap.events import EventStream, Subscriber
 from sinap.module import Module
 
 
@@ -8,27 +16,197 @@ class HTTPModule(Module):
     def __init__(self, *args, **kwds):
         super().__init__(*args, **kwds)
         self._app = Application()
-        self._server = None
+        self._servers = []
+        self._inherited = []
         self._handler = None
         self._started = False
+        self._events = None
+
+    def startup(self):
+        # Listening sockets inherited from the process before a restart.
+        # Start serving on them as soon as the modules have been
+        # loaded, even if no routes are added.
+        self._inherited = self._inherit_sockets()
+        if self._inherited:
+            self._maybe_start()
+
+        if self.config.get('metrics', False):
+            self.add_routes([
+                ('GET', '/metrics', self._metrics),
+                ('GET', '/metrics.json', self._metrics_json),
+            ])
+        if self.config.get('traces', False):
+            self.add_route('GET', '/traces.json', self._traces_json)
+        if self.config.get('profiles', False):
+            self.add_route('GET', '/profiles/{name}', self._profile,
+                           name='profile')
+        if self.config.get('events', False):
+            self._events = EventStream(self.bot.metrics)
+            self.add_routes([
+                ('GET', '/events', self._events_sse),
+                ('GET', '/events/ws', self._events_websocket),
+            ])
+
+    def on_irc_message(self, net, message):
+        if self._events is not None:
+            self._events.publish(net.name, message)
+
+    async def _metrics(self, request):
+        return Response(
+            text=self.bot.metrics.render_prometheus(),
+            content_type='text/plain',
+            headers={'X-Content-Type-Options': 'nosniff'},
+        )
+
+    async def _metrics_json(self, request):
+        return Response(
+            text=self.bot.metrics.render_json(),
+            content_type='application/json',
+        )
+
+    async def _traces_json(self, request):
+        return Response(
+            text=json.dumps(list(self.bot.tracer.slow)),
+            content_type='application/json',
+        )
+
+    async def _profile(self, request):
+        name = request.match_info['name']
+        if not self.bot.datadir or '/' in name or name.startswith('.'):
+            raise HTTPNotFound()
+
+        path = self.bot.datadir / 'profiles' / name
+        if not path.is_file():
+            raise HTTPNotFound()
+
+        return Response(
+            text=path.read_text(),
+            content_type='text/plain',
+            headers={
+                'Content-Disposition': 'attachment; filename="%s"' % name,
+            },
+        )
+
+    def _subscriber(self, request):
+        # Filters are comma separated lists in the query string, e.g.
+        # /events?network=freenode&channel=%23sinap&type=privmsg,join
+        def values(name, lower=False):
+            value = request.query.get(name)
+            if not value:
+                return None
+            if lower:
+                value = value.lower()
+            return set(value.split(','))
+
+        return Subscriber(
+            networks=values('network'),
+            channels=values('channel', lower=True),
+            types=values('type', lower=True),
+            max_buffer=self.config.get('events_buffer', 1000),
+        )
+
+    async def _stream_events(self, request, write, heartbeat):
+        # Pass batches of events to write() until the client falls
+        # behind or disconnects. Handlers aren't cancelled when the
+        # client goes away, so call heartbeat() when there's nothing
+        # to write to find out.
+        subscriber = self._subscriber(request)
+        timeout = self.config.get('events_write_timeout', 10)
+        interval = self.config.get('events_heartbeat', 15)
+        self._events.subscribe(subscriber)
+        try:
+            while True:
+                try:
+                    events = await asyncio.wait_for(subscriber.get(),
+                                                    interval)
+                except asyncio.TimeoutError:
+                    await asyncio.wait_for(heartbeat(), timeout)
+                    continue
+                if events is None:
+                    self.log.info('Disconnecting slow event stream client %s'
+                                  % request.remote)
+                    return
+                await asyncio.wait_for(write(events), timeout)
+        except asyncio.TimeoutError:
+            subscriber.overflowed = True
+            self.log.info('Disconnecting stalled event stream client %s' %
+                          request.remote)
+        finally:
+            self._events.unsubscribe(subscriber)
+
+    async def _events_sse(self, request):
+        response = StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+        })
+        await response.prepare(request)
+
+        async def write(events):
+            await response.write(b''.join(event.sse() for event in events))
+
+        async def heartbeat():
+            # A comment line, ignored by clients
+            await response.write(b':\n\n')
+
+        try:
+            await self._stream_events(request, write, heartbeat)
+        except ConnectionError:
+            self.log.info('Event stream client %s disconnected' %
+                          request.remote)
+        return response
 
-    def add_route(self, method, path, handler):
-        self._app.router.add_route(method, path, handler)
+    async def _events_websocket(self, request):
+        ws = WebSocketResponse()
+        await ws.prepare(request)
+
+        async def write(events):
+            for event in events:
+                await ws.send_str(event.data)
+
+        # Reading is needed to notice the client closing the socket,
+        # and closing the socket when the stream ends stops reading
+        async def heartbeat():
+            await ws.ping()
+
+        stream = self.loop.create_task(
+            self._stream_events(request, write, heartbeat)
+        )
+        stream.add_done_callback(lambda f: self.loop.create_task(ws.close()))
+        try:
+            async for msg in ws:
+                pass
+        finally:
+            stream.cancel()
+        return ws
+
+    def add_route(self, method, path, handler, name=None):
+        # Routes with a name can be passed to reverse_url()
+        self._app.router.add_route(method, path, handler, name=name)
 
         # Start when the first handlers are added
         self._maybe_start()
 
     def add_routes(self, routes):
-        # routes is a list of (method, path, handler) tuples
-        for method, path, handler in routes:
-            self._app.router.add_route(method, path, handler)
+        # routes is a list of (method, path, handler) or (method,
+        # path, handler, name) tuples
+        for route in routes:
+            method, path, handler = route[:3]
+            name = route[3] if len(route) > 3 else None
+            self._app.router.add_route(method, path, handler, name=name)
 
         # Start when the first handlers are added
         self._maybe_start()
 
-    def reverse_url(self, name, *args):
+    # Usage: http.reverse_url('paste', id='abc')
+    def reverse_url(self, name, **parts):
         baseurl = self.config.get('baseurl', '')
-        return baseurl + self._app.reverse_url(name, *args)
+        resource = self._app.router[name]
+        if hasattr(resource, 'url_for'):
+            url = str(resource.url_for(**parts))
+        else:
+            # aiohttp < 2.0
+            url = resource.url(parts=parts)
+        return baseurl.rstrip('/') + url
 
     def _maybe_start(self):
         if not self._started:
@@ -36,21 +214,91 @@ class HTTPModule(Module):
             self._started = True
             self.loop.create_task(self._start())
 
-    async def _start(self):
+    def _address(self):
         address = self.config.get('address', '127.0.0.1')
         port = self.config.get('port', 8000)
+        if self.bot.worker and not self.config.get('reuse_port', False):
+            # Each worker process gets its own port, unless they share
+            # one with SO_REUSEPORT and let the kernel balance
+            # connections between them
+            port += self.bot.worker
+        return address, port
 
-        self.log.info('Starting HTTP server at %s:%s' % (address, port))
+    def _inherit_sockets(self):
+        state = self.take_restart_state()
+        if not state:
+            return []
+
+        sockets = [
+            socket.socket(family, socket.SOCK_STREAM, fileno=fileno)
+            for fileno, family in state['sockets']
+        ]
+
+        # The configuration may have changed in between. Resolve the
+        # address like create_server() does and compare the addresses
+        # the sockets are bound to.
+        address, port = self._address()
+        try:
+            wanted = {
+                info[4][:2] for info in socket.getaddrinfo(
+                    address, port, type=socket.SOCK_STREAM,
+                    flags=socket.AI_PASSIVE,
+                )
+            }
+        except OSError as exc:
+            self.log.warning('Unable to resolve %s: %s' % (address, exc))
+            wanted = set()
+        if {sock.getsockname()[:2] for sock in sockets} != wanted:
+            self.log.info('HTTP address changed, not reusing the old sockets')
+            for sock in sockets:
+                sock.close()
+            return []
+
+        return sockets
+
+    async def _start(self):
         self._handler = self._app.make_handler()
-        self._server = await self.loop.create_server(self._handler, address, port)
+
+        if self._inherited:
+            self.log.info('Starting HTTP server at %s' % ', '.join(
+                '%s:%s' % sock.getsockname()[:2] for sock in self._inherited
+            ))
+            for sock in self._inherited:
+                self._servers.append(
+                    await self.loop.create_server(self._handler, sock=sock)
+                )
+            self._inherited = []
+            return
+
+        address, port = self._address()
+        self.log.info('Starting HTTP server at %s:%s' % (address, port))
+        self._servers.append(await self.loop.create_server(
+            self._handler, address, port,
+            reuse_port=self.config.get('reuse_port', False) or None,
+        ))
+
+    def dump_state(self):
+        # Keep listening on the same sockets in the new process, so
+        # that no connection is refused during the restart
+        sockets = [sock for server in self._servers
+                   for sock in server.sockets or []]
+        if not sockets:
+            return None
+
+        for sock in sockets:
+            os.set_inheritable(sock.fileno(), True)
+        return {
+            'sockets': [[sock.fileno(), int(sock.family)] for sock in sockets],
+        }
 
     def shutdown(self):
         if self._started:
             self.loop.create_task(self._shutdown_server())
 
     async def _shutdown_server(self):
-        self._server.close()
-        await self._server.wait_closed()
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
         await self._app.shutdown()
         await self._handler.finish_connections(1.0)
         await self._app.cleanup()
@@ -0,0 +1,259 @@
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import asyncio
+import json
+import time
+
+import aiohttp
+
+from sinap.module import Module
+
+
+# A shared HTTP client for modules, with keep-alive connections,
+# concurrency limits, coalescing of identical in-flight GET requests
+# and a response cache.
+#
+# Usage in modules:
+#
+#   client = self.bot.exports['http_client']
+#   response = await client.get('https://example.com/')
+#   if response.status == 200:
+#       self.say(scope, response.text()[:100])
+
+
+class HTTPResponse(object):
+    def __init__(self, url, status, headers, body, truncated=False):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+        # True if the body was cut at max_size
+        self.truncated = truncated
+
+    def text(self, encoding=None):
+        if encoding is None:
+            encoding = 'utf-8'
+            content_type = self.headers.get('Content-Type', '')
+            for param in content_type.split(';')[1:]:
+                name, _, value = param.strip().partition('=')
+                if name.lower() == 'charset' and value:
+                    encoding = value.strip('"')
+        try:
+            return self.body.decode(encoding, 'replace')
+        except LookupError:
+            return self.body.decode('utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.text())
+
+    def size(self):
+        # Approximate memory taken by the response in the cache
+        return (len(self.body) + len(self.url) + 200 +
+                sum(len(key) + len(value)
+                    for key, value in self.headers.items()))
+
+
+def parse_http_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def cache_ttl(response, default_ttl):
+    # Seconds the response may be served from the cache, or 0
+    if response.status != 200 or response.truncated:
+        return 0
+
+    headers = response.headers
+    directives = {}
+    for directive in headers.get('Cache-Control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        directives[name.lower()] = value.strip('"')
+
+    if 'no-store' in directives or 'no-cache' in directives:
+        return 0
+
+    try:
+        age = max(0, int(headers.get('Age', 0)))
+    except ValueError:
+        age = 0
+
+    if 'max-age' in directives:
+        try:
+            return max(0, int(directives['max-age']) - age)
+        except ValueError:
+            return 0
+
+    if 'Expires' in headers:
+        expires = parse_http_date(headers['Expires'])
+        if expires is None:
+            # Invalid dates mean already expired
+            return 0
+        date = parse_http_date(headers.get('Date', '')) or time.time()
+        return max(0, expires - date - age)
+
+    return default_ttl
+
+
+class HTTPClientModule(Module):
+    export_as = 'http_client'
+
+    def __init__(self, *args, **kwds):
+        super().__init__(*args, **kwds)
+
+        self.timeout = self.config.get('timeout', 10)
+        self.max_size = self.config.get('max_size', 1024 * 1024)
+        self.user_agent = self.config.get('user_agent', 'sinap')
+        self.default_ttl = self.config.get('default_ttl', 60)
+        self.cache_size = self.config.get('cache_size', 8 * 1024 * 1024)
+
+        self.max_connections = self.config.get('max_connections', 20)
+        self.per_host = self.config.get('per_host', 4)
+        self._connections = asyncio.Semaphore(self.max_connections)
+
+        # host -> [semaphore, number of requests using it]
+        self._hosts = {}
+
+        # Created on first use, when the loop is running
+        self._session = None
+
+        # (url, headers, max_size) -> Future of HTTPResponse
+        self._inflight = {}
+
+        # (url, headers, max_size) -> (expires, HTTPResponse), least
+        # recently used first
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+
+        metrics = self.bot.metrics
+        self._requests = metrics.counter(
+            'sinap_http_client_requests_total',
+            'HTTP client requests by how they were served',
+            ['result'],
+        )
+        metrics.gauge(
+            'sinap_http_client_cache_bytes',
+            'Approximate size of the HTTP client cache',
+        ).set_function(lambda: self._cache_bytes)
+
+    async def get(self, url, headers=None, max_size=None):
+        # Fetch url, or return a cached or in-flight response for it
+        if max_size is None:
+            max_size = self.max_size
+        key = (url, tuple(sorted((headers or {}).items())), max_size)
+
+        cached = self._cache.get(key)
+        if cached is not None:
+            expires, response = cached
+            if expires > time.monotonic():
+                self._cache.move_to_end(key)
+                self._requests.labels('cache').inc()
+                return response
+            self._uncache(key)
+
+        future = self._inflight.get(key)
+        if future is None:
+            self._requests.labels('fetch').inc()
+            future = self.loop.create_task(self._fetch_and_cache(
+                key, url, headers, max_size,
+            ))
+            self._inflight[key] = future
+            future.add_done_callback(lambda f: self._inflight.pop(key, None))
+        else:
+            self._requests.labels('coalesced').inc()
+
+        # Don't let one caller's cancellation cancel the others
+        return await asyncio.shield(future)
+
+    async def request(self, method, url, headers=None, data=None,
+                      max_size=None):
+        # Make a request without caching or coalescing
+        if max_size is None:
+            max_size = self.max_size
+        self._requests.labels('uncached').inc()
+        return await self._fetch(method, url, headers, data, max_size)
+
+    async def _fetch_and_cache(self, key, url, headers, max_size):
+        response = await self._fetch('GET', url, headers, None, max_size)
+
+        ttl = cache_ttl(response, self.default_ttl)
+        size = response.size()
+        # Don't let a single response flush most of the cache
+        if ttl > 0 and size <= self.cache_size // 4:
+            self._uncache(key)
+            self._cache[key] = (time.monotonic() + ttl, response)
+            self._cache_bytes += size
+            while self._cache_bytes > self.cache_size:
+                self._uncache(next(iter(self._cache)))
+
+        return response
+
+    def _uncache(self, key):
+        cached = self._cache.pop(key, None)
+        if cached is not None:
+            self._cache_bytes -= cached[1].size()
+
+    async def _fetch(self, method, url, headers, data, max_size):
+        host = urlsplit(url).netloc
+        limit = self._hosts.get(host)
+        if limit is None:
+            limit = self._hosts[host] = [asyncio.Semaphore(self.per_host), 0]
+        limit[1] += 1
+
+        try:
+            async with limit[0]:
+                async with self._connections:
+                    return await asyncio.wait_for(
+                        self._do_fetch(method, url, headers, data, max_size),
+                        self.timeout,
+                    )
+        finally:
+            limit[1] -= 1
+            if not limit[1]:
+                del self._hosts[host]
+
+    async def _do_fetch(self, method, url, headers, data, max_size):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                headers={'User-Agent': self.user_agent},
+            )
+
+        response = await self._session.request(method, url, headers=headers,
+                                               data=data)
+        complete = False
+        try:
+            chunks = []
+            size = 0
+            truncated = False
+            while True:
+                chunk = await response.content.read(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > max_size:
+                    truncated = True
+                    break
+
+            body = b''.join(chunks)[:max_size]
+            complete = not truncated
+            return HTTPResponse(str(response.url), response.status,
+                                response.headers.copy(), body, truncated)
+        finally:
+            if complete:
+                response.release()
+            else:
+                # Don't reuse a connection with unread data
+                response.close()
+
+    def shutdown(self):
+        self._cache.clear()
+        self._cache_bytes = 0
+        if self._session is not None:
+            result = self._session.close()
+            if asyncio.iscoroutine(result):
+                self.loop.create_task(result)
+            self._session = None
@@ -0,0 +1,120 @@
+from collections import OrderedDict
+import os
+import time
+
+from aiohttp.web import HTTPNotFound, Response
+from sinap.module import Module
+
+
+# Stores long texts and serves them over HTTP, so that the bot can say
+# a link instead of flooding a channel. Module.say_lines() uses this
+# for output longer than line_budget lines. Pastes are kept in memory
+# and, if there's a datadir, in datadir/pastes for ttl seconds.
+#
+# Served by the http module only when it has a baseurl, since the links
+# would be useless otherwise.
+
+class PasteModule(Module):
+    export_as = 'paste'
+
+    def __init__(self, *args, **kwds):
+        super().__init__(*args, **kwds)
+
+        self.line_budget = self.config.get('line_budget', 5)
+        self.ttl = self.config.get('ttl', 7 * 24 * 3600)
+        self.memory_items = self.config.get('memory_items', 100)
+
+        # id -> (expires, text), oldest first
+        self._pastes = OrderedDict()
+        self._http = None
+        self._directory = None
+
+    def startup(self):
+        http = self.bot.exports.get('http')
+        if not http or not http.config.get('baseurl'):
+            return
+
+        self._http = http
+        http.add_route('GET', '/paste/{id}', self._serve, name='paste')
+
+        if self.bot.datadir:
+            self._directory = self.bot.datadir / 'pastes'
+            if not self._directory.exists():
+                self._directory.mkdir()
+            self._expire()
+
+    @property
+    def available(self):
+        return self._http is not None
+
+    def create(self, text, title=None):
+        # Store text and return its URL, or None if pastes are not
+        # served
+        if not self.available:
+            return None
+
+        if title:
+            text = '%s\n\n%s' % (title, text)
+        if not text.endswith('\n'):
+            text += '\n'
+
+        paste_id = os.urandom(8).hex()
+        self._pastes[paste_id] = (time.time() + self.ttl, text)
+        while len(self._pastes) > self.memory_items:
+            self._pastes.popitem(last=False)
+
+        if self._directory:
+            self.loop.run_in_executor(None, self._write, paste_id, text)
+
+        return self._http.reverse_url('paste', id=paste_id)
+
+    async def _serve(self, request):
+        paste_id = request.match_info['id']
+        now = time.time()
+
+        paste = self._pastes.get(paste_id)
+        if paste is not None:
+            expires, text = paste
+            if expires < now:
+                raise HTTPNotFound()
+        else:
+            text = await self.loop.run_in_executor(None, self._read, paste_id)
+            if text is None:
+                raise HTTPNotFound()
+
+        return Response(text=text, content_type='text/plain')
+
+    def _path(self, paste_id):
+        if not self._directory or not paste_id.isalnum():
+            return None
+        return self._directory / ('%s.txt' % paste_id)
+
+    # These run in an executor thread
+
+    def _write(self, paste_id, text):
+        try:
+            self._path(paste_id).write_text(text)
+        except OSError as exc:
+            self.log.warning('Unable to save paste %s: %s' % (paste_id, exc))
+
+    def _read(self, paste_id):
+        path = self._path(paste_id)
+        try:
+            if path is None or path.stat().st_mtime + self.ttl < time.time():
+                return None
+            return path.read_text()
+        except OSError:
+            return None
+
+    def _remove_expired(self):
+        expired = time.time() - self.ttl
+        for path in self._directory.glob('*.txt'):
+            try:
+                if path.stat().st_mtime < expired:
+                    path.unlink()
+            except OSError:
+                pass
+
+    def _expire(self):
+        self.loop.run_in_executor(None, self._remove_expired)
+        self.call_later(3600, self._expire)
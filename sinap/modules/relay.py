@@ -0,0 +1,199 @@
+from collections import deque
+import time
+
+from sinap.module import Module
+
+
+# Relays messages between linked channels, possibly on different
+# networks. Every channel of a link gets the messages said on the
+# others. Each destination channel has its own queue, and a message is
+# handed to a network only when the network's own send queue is short,
+# so a network that is being rate limited holds back only its own
+# relayed messages. When a destination falls behind, its queued
+# messages are coalesced into fewer, longer lines.
+#
+# Configuration:
+#
+#   modulesets:
+#     core:
+#       relay:
+#         links:
+#           - ['freenode/#sinap', 'oftc/#sinap']
+#         ignore: ['otherbot']    # nicks whose messages are not relayed
+#         max_queue: 100          # per destination, oldest dropped
+#         coalesce_after: 3       # queued messages before coalescing
+#         max_line: 400
+
+class Destination(object):
+    def __init__(self, network, channel):
+        self.network = network
+        self.channel = channel
+
+        # (queued at, source network, text)
+        self.queue = deque()
+        self.sent = 0
+        self.dropped = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.pump_handle = None
+
+    @property
+    def name(self):
+        return '%s/%s' % (self.network, self.channel)
+
+
+def parse_endpoint(endpoint):
+    network, sep, channel = endpoint.partition('/')
+    if not sep or not channel:
+        raise ValueError('Invalid relay endpoint, expected '
+                         'network/#channel: %s' % endpoint)
+    return network, channel.lower()
+
+
+class RelayModule(Module):
+    admin_commands = {
+        'relays': 'Show relay queues and lag',
+    }
+
+    def __init__(self, *args, **kwds):
+        super().__init__(*args, **kwds)
+
+        self.max_queue = self.config.get('max_queue', 100)
+        self.coalesce_after = self.config.get('coalesce_after', 3)
+        self.max_line = self.config.get('max_line', 400)
+        self.max_pending = self.config.get('max_pending', 2)
+        self.poll_interval = self.config.get('poll_interval', 0.25)
+        self.ignore = set(nick.lower()
+                          for nick in self.config.get('ignore', []))
+
+        # (network, channel) -> Destination
+        self.destinations = {}
+
+        # (network, channel) -> [Destination] to relay to
+        self.routes = {}
+
+        for link in self.config.get('links', []):
+            endpoints = [parse_endpoint(endpoint) for endpoint in link]
+            for endpoint in endpoints:
+                if endpoint not in self.destinations:
+                    self.destinations[endpoint] = Destination(*endpoint)
+            for source in endpoints:
+                routes = self.routes.setdefault(source, [])
+                for endpoint in endpoints:
+                    destination = self.destinations[endpoint]
+                    if endpoint != source and destination not in routes:
+                        routes.append(destination)
+
+        if not self.routes:
+            self.admin_commands = {}
+
+        metrics = self.bot.metrics
+        self._lag = metrics.histogram(
+            'sinap_relay_lag_seconds',
+            'Time relayed messages wait in the relay queue',
+            ['destination'],
+        )
+        self._dropped = metrics.counter(
+            'sinap_relay_dropped_total',
+            'Relayed messages dropped because the queue was full',
+            ['destination'],
+        )
+        queued = metrics.gauge(
+            'sinap_relay_queued', 'Messages waiting in the relay queue',
+            ['destination'],
+        )
+        for destination in self.destinations.values():
+            queued.labels(destination.name).set_function(
+                lambda destination=destination: len(destination.queue)
+            )
+
+    def on_irc_message(self, net, message):
+        if message.command != 'PRIVMSG' or len(message.args) < 2:
+            return
+
+        routes = self.routes.get((net.name, message.args[0].lower()))
+        if not routes:
+            return
+
+        nick = (message.prefix or '').split('!', 1)[0]
+        # Never relay the bot's own messages, they may be relayed
+        # messages
+        if nick.lower() in self.ignore or \
+                (net.nick and nick.lower() == net.nick.lower()):
+            return
+
+        text = message.args[1]
+        if text.startswith('\x01ACTION ') and text.endswith('\x01'):
+            text = '* %s %s' % (nick, text[8:-1])
+        elif text.startswith('\x01'):
+            # Other CTCP
+            return
+        else:
+            text = '<%s> %s' % (nick, text)
+
+        now = time.monotonic()
+        for destination in routes:
+            if len(destination.queue) >= self.max_queue:
+                destination.queue.popleft()
+                destination.dropped += 1
+                self._dropped.labels(destination.name).inc()
+            destination.queue.append((now, net.name, text))
+            self._pump(destination)
+
+    def _pump_later(self, destination):
+        destination.pump_handle = None
+        self._pump(destination)
+
+    def _pump(self, destination):
+        net = self.bot.get_network(destination.network)
+        while destination.queue and net is not None and \
+                net.pending_sends() < self.max_pending:
+            line, queued_at = self._next_line(destination)
+            net.privmsg(destination.channel, line)
+
+            lag = time.monotonic() - queued_at
+            destination.sent += 1
+            destination.last_lag = lag
+            destination.max_lag = max(destination.max_lag, lag)
+            self._lag.labels(destination.name).observe(lag)
+
+        if destination.queue and destination.pump_handle is None:
+            # Check again when the network has had time to send
+            destination.pump_handle = self.call_later(
+                self.poll_interval, self._pump_later, destination,
+            )
+
+    def _next_line(self, destination):
+        # Take the next line to send from the queue, and the time its
+        # oldest message was queued
+        queue = destination.queue
+        queued_at, network, text = queue.popleft()
+        line = '[%s] %s' % (network, text)
+        if len(queue) < self.coalesce_after:
+            return line, queued_at
+
+        # Behind: join messages from the same network while they fit
+        while queue and queue[0][1] == network:
+            joined = '%s | %s' % (line, queue[0][2])
+            if len(joined.encode('utf-8')) > self.max_line:
+                break
+            line = joined
+            queue.popleft()
+        return line, queued_at
+
+    def command_relays(self, user, scope):
+        if not self.destinations:
+            self.say(scope, 'No relays configured')
+            return
+
+        lines = []
+        for key, destination in sorted(self.destinations.items()):
+            lines.append(
+                '%s: %d queued, %d sent, %d dropped, lag %.1fs '
+                '(max %.1fs)' % (
+                    destination.name, len(destination.queue), destination.sent,
+                    destination.dropped, destination.last_lag,
+                    destination.max_lag,
+                )
+            )
+        self.say_lines(scope, lines, title='Relays')
@@ -0,0 +1,221 @@
+from collections import OrderedDict
+import hmac
+import json
+import os
+import re
+import time
+
+from aiohttp.web import HTTPForbidden, HTTPNotFound, Response
+from sinap.module import Module
+
+
+# Receives JSON events at POST /webhooks/<name> and says them on the
+# hook's channel. Events for the same channel that arrive within
+# window seconds are coalesced: up to max_lines are said as is, and
+# larger bursts as a digest whose full details are served over HTTP.
+# Digests need a baseurl in the http module's config, without it the
+# events of a burst are listed like other long replies.
+#
+# Configuration:
+#
+#   modulesets:
+#     core:
+#       webhooks:
+#         window: 5
+#         max_lines: 3
+#         max_length: 300             # characters per said line
+#         hooks:
+#           ci:
+#             network: freenode
+#             channel: '#sinap'
+#             token: secret           # X-Sinap-Token header
+#             format: '{repo}: {status} {message}'   # optional
+#
+# Without format, the event's text, message, title or summary field is
+# said. Hooks without a token are not enabled.
+
+SUMMARY_FIELDS = ('text', 'message', 'title', 'summary')
+
+# Line breaks would let the payload send arbitrary IRC commands
+CONTROL_RE = re.compile(r'[\x00-\x1f\x7f]+')
+
+
+class FormatValues(dict):
+    # Missing fields format as empty
+    def __missing__(self, key):
+        return ''
+
+
+def summarize(event, fmt=None, max_length=300):
+    text = summary_text(event, fmt)
+
+    # One line without control characters, e.g. the first line of a
+    # multi-line commit message followed by the rest
+    text = CONTROL_RE.sub(' ', text).strip()
+    if len(text) > max_length:
+        text = text[:max_length - 3] + '...'
+    return text
+
+
+def summary_text(event, fmt):
+    if not isinstance(event, dict):
+        return str(event)
+
+    if fmt:
+        try:
+            return fmt.format_map(FormatValues(event))
+        except (ValueError, AttributeError, IndexError, KeyError):
+            pass
+
+    for field in SUMMARY_FIELDS:
+        if isinstance(event.get(field), str):
+            return event[field]
+    return json.dumps(event, sort_keys=True)
+
+
+class WebhooksModule(Module):
+    def __init__(self, *args, **kwds):
+        super().__init__(*args, **kwds)
+
+        self.hooks = {}
+        for name, hook in self.config.get('hooks', {}).items():
+            if not hook.get('token'):
+                self.log.error('Webhook %s has no token, not enabling it' %
+                               name)
+                continue
+            self.hooks[name] = hook
+
+        self.max_length = self.config.get('max_length', 300)
+        self.window = self.config.get('window', 5)
+        self.max_lines = max(1, self.config.get('max_lines', 3))
+        self.max_events = self.config.get('max_events', 1000)
+
+        # (network, channel) -> [(hook name, event, summary)]
+        self._pending = {}
+        # (network, channel) -> timeout handle
+        self._timers = {}
+
+        # digest id -> (time, network, channel, events), oldest first
+        self._digests = OrderedDict()
+        self._serve_digests = False
+
+        self._received = self.bot.metrics.counter(
+            'sinap_webhook_events_total', 'Events received by webhook',
+            ['hook'],
+        )
+        self._lines = self.bot.metrics.counter(
+            'sinap_webhook_lines_total', 'Lines said for webhook events',
+        )
+
+    def startup(self):
+        if not self.hooks:
+            return
+
+        http = self.bot.exports.get('http')
+        if not http:
+            self.log.error('Webhooks require the http module')
+            return
+
+        self._http = http
+        http.add_route('POST', '/webhooks/{name}', self._receive)
+        if http.config.get('baseurl'):
+            http.add_route('GET', '/webhooks/digests/{id}', self._digest,
+                           name='webhook_digest')
+            self._serve_digests = True
+
+    async def _receive(self, request):
+        name = request.match_info['name']
+        hook = self.hooks.get(name)
+        if hook is None:
+            raise HTTPNotFound()
+
+        given = request.headers.get('X-Sinap-Token', '')
+        if not hmac.compare_digest(given.encode(),
+                                   str(hook['token']).encode()):
+            raise HTTPForbidden()
+
+        try:
+            events = json.loads((await request.read()).decode('utf-8'))
+        except ValueError:
+            return Response(status=400, text='Invalid JSON\n')
+        if not isinstance(events, list):
+            events = [events]
+
+        self._received.labels(name).inc(len(events))
+
+        destination = (hook['network'], hook['channel'])
+        pending = self._pending.setdefault(destination, [])
+        # Bound the memory used by an event storm
+        events = events[:max(0, self.max_events - len(pending))]
+        for event in events:
+            pending.append((name, event, summarize(
+                event, hook.get('format'), self.max_length,
+            )))
+
+        if destination not in self._timers:
+            self._timers[destination] = self.call_later(
+                self.window, self._flush, destination,
+            )
+
+        return Response(status=202, content_type='application/json',
+                        text=json.dumps({'queued': len(events)}))
+
+    def _flush(self, destination):
+        del self._timers[destination]
+        events = self._pending.pop(destination, [])
+        if not events:
+            return
+
+        network, channel = destination
+        try:
+            scope = self.make_scope(network, channel)
+        except ValueError as exc:
+            self.log.warning('Dropping webhook events: %s' % exc)
+            return
+
+        lines = ['[%s] %s' % (name, summary) for name, _, summary in events]
+        scope.recorder = []
+        if len(events) <= self.max_lines:
+            for line in lines:
+                self.say(scope, line)
+        elif self._serve_digests:
+            names = sorted(set(name for name, _, _ in events))
+            for line in lines[:self.max_lines - 1]:
+                self.say(scope, line)
+            self.say(scope, '[%s] ... and %d more: %s' % (
+                ', '.join(names), len(events) - self.max_lines + 1,
+                self._store_digest(network, channel, events),
+            ))
+        else:
+            self.say_lines(scope, lines, title='Webhook events')
+        self._lines.inc(len(scope.recorder))
+
+    def _store_digest(self, network, channel, events):
+        digest_id = os.urandom(8).hex()
+        self._digests[digest_id] = (time.time(), network, channel, events)
+        while len(self._digests) > self.config.get('keep', 100):
+            self._digests.popitem(last=False)
+
+        return self._http.reverse_url('webhook_digest', id=digest_id)
+
+    async def _digest(self, request):
+        digest = self._digests.get(request.match_info['id'])
+        if digest is None:
+            raise HTTPNotFound()
+
+        received, network, channel, events = digest
+        lines = ['%d events for %s on %s, %s' % (
+            len(events), channel, network,
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(received)),
+        ), '']
+        for name, event, summary in events:
+            lines.append('[%s] %s' % (name, summary))
+            lines.append('    %s' % json.dumps(event, sort_keys=True))
+
+        return Response(text='\n'.join(lines) + '\n',
+                        content_type='text/plain')
+
+    def shutdown(self):
+        # Say what is pending instead of losing it on reload
+        for destination in list(self._timers):
+            self._flush(destination)
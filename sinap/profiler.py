@@ -0,0 +1,116 @@
+import collections
+import os
+import sys
+import time
+import tracemalloc
+
+
+def describe(code_key):
+    filename, lineno, name = code_key
+    return '%s (%s:%d)' % (name, os.path.basename(filename), lineno)
+
+
+class SamplingProfiler(object):
+    # Samples the stack of another thread at a fixed interval. The
+    # profiled thread doesn't do any extra work, so this is cheap
+    # enough to run in a live bot.
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+
+        # (filename, first line, function name) -> count
+        self.own = collections.Counter()
+        self.cumulative = collections.Counter()
+
+    def run(self, seconds):
+        # Blocks for the given time, run in a separate thread
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.sample(frame)
+            time.sleep(self.interval)
+
+    def sample(self, frame):
+        self.samples += 1
+
+        seen = set()
+        top = True
+        while frame is not None:
+            code = frame.f_code
+            key = (code.co_filename, code.co_firstlineno, code.co_name)
+            if top:
+                self.own[key] += 1
+                top = False
+            if key not in seen:
+                self.cumulative[key] += 1
+                seen.add(key)
+            frame = frame.f_back
+
+    def top(self, limit=10):
+        # [(description, percentage of samples)]
+        return [
+            (describe(key), 100.0 * count / self.samples)
+            for key, count in self.own.most_common(limit)
+        ]
+
+    def report(self, limit=40):
+        lines = ['%d samples' % self.samples, '']
+        if not self.samples:
+            return '\n'.join(lines) + '\n'
+
+        for title, counter in (('Own time', self.own),
+                               ('Cumulative time', self.cumulative)):
+            lines.append(title)
+            for key, count in counter.most_common(limit):
+                lines.append('%6.2f%%  %s' % (100.0 * count / self.samples,
+                                              describe(key)))
+            lines.append('')
+
+        return '\n'.join(lines)
+
+
+class MemoryProfiler(object):
+    # Takes tracemalloc snapshots at start and stop and compares them
+
+    def __init__(self, frames=10):
+        self.frames = frames
+        self.stats = []
+        self._started_tracing = False
+        self._before = None
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._started_tracing = True
+        self._before = tracemalloc.take_snapshot()
+
+    def stop(self):
+        after = tracemalloc.take_snapshot()
+        if self._started_tracing:
+            tracemalloc.stop()
+
+        filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ]
+        self.stats = after.filter_traces(filters).compare_to(
+            self._before.filter_traces(filters), 'lineno',
+        )
+        self._before = None
+
+    def top(self, limit=10):
+        # [(description, size difference in bytes)]
+        return [
+            ('%s:%d' % (os.path.basename(stat.traceback[0].filename),
+                        stat.traceback[0].lineno), stat.size_diff)
+            for stat in self.stats[:limit]
+        ]
+
+    def report(self, limit=40):
+        lines = ['Allocation sites by growth', '']
+        for stat in self.stats[:limit]:
+            lines.append(str(stat))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,191 @@
+from pathlib import Path
+import asyncio
+import sys
+import tempfile
+import time
+
+import yaml
+
+from sinap.bot import Bot
+from sinap.capture import read_capture
+
+
+# Feeds traffic captured by a network's "capture" option back through
+# a real Bot with its modules. A local server stands in for the IRC
+# server: once the bot has registered, it sends the captured lines
+# either with their original timing (scaled by speed) or as fast as
+# possible, and records everything the bot sends back.
+
+
+# Module configuration overridden in the replay, so that the modules
+# don't reach outside it: listen on the live bot's HTTP port, accept
+# webhooks or relay to other networks
+MODULE_OVERRIDES = {
+    'http': {'address': '127.0.0.1', 'port': 0, 'reuse_port': False},
+    'webhooks': {'hooks': {}},
+    'relay': {'links': []},
+}
+
+
+def replay_config(config_file, network, port, datadir):
+    with open(config_file) as fobj:
+        config = yaml.safe_load(fobj)
+
+    networks = config.get('networks', {})
+    if network is None:
+        if len(networks) != 1:
+            raise ValueError('Choose a network with --network: %s' %
+                             ', '.join(sorted(networks)))
+        network = next(iter(networks))
+    if network not in networks:
+        raise ValueError('No such network: %s' % network)
+
+    net_config = dict(networks[network])
+    for key in ('servers', 'ssl', 'ssl_cafile', 'ssl_verify', 'password',
+                'capture', 'worker'):
+        net_config.pop(key, None)
+    net_config['server'] = '127.0.0.1'
+    net_config['port'] = port
+    # The output should reflect what the modules said, not flood
+    # protection
+    net_config['send_burst'] = 10**9
+
+    config['networks'] = {network: net_config}
+
+    modulesets = config.setdefault('modulesets', {})
+    core = modulesets.get('core')
+    if not isinstance(core, dict):
+        core = modulesets['core'] = {}
+    for name, overrides in MODULE_OVERRIDES.items():
+        core[name] = dict(core.get(name) or {}, **overrides)
+
+    # Keep the live bot's data out of reach
+    config['datadir'] = str(datadir)
+    return config
+
+
+class ReplayServer(object):
+    def __init__(self, records, output, speed=1.0, timestamps=False):
+        self.records = records
+        self.output = output
+        self.speed = speed
+        self.timestamps = timestamps
+
+        self.lines_replayed = 0
+        self.lines_sent = 0
+        self.started = None
+        self.finished = None
+        self.done = asyncio.Event()
+
+        self._registered = asyncio.Event()
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self.accept, '127.0.0.1', 0,
+        )
+        return self._server.sockets[0].getsockname()[1]
+
+    def stop(self):
+        self._server.close()
+
+    async def accept(self, reader, writer):
+        if self.started is not None:
+            # The bot reconnected, e.g. because a module made it quit
+            writer.close()
+            return
+
+        feed = asyncio.ensure_future(self.feed(writer))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.bot_sent(line.rstrip(b'\r\n'))
+        finally:
+            feed.cancel()
+            self.done.set()
+
+    def bot_sent(self, line):
+        if line.startswith(b'USER '):
+            self._registered.set()
+
+        self.lines_sent += 1
+        if self.timestamps:
+            elapsed = 0.0
+            if self.started is not None:
+                elapsed = time.monotonic() - self.started
+            self.output.write(b'%.3f ' % elapsed)
+        self.output.write(line + b'\n')
+
+    async def feed(self, writer):
+        await self._registered.wait()
+        self.started = time.monotonic()
+
+        # Seconds from start at which the next line is due. Gaps are
+        # measured between consecutive lines so that a capture spanning
+        # a reboot, where the monotonic clock starts over, still works.
+        due = 0.0
+        previous = None
+        for timestamp, line in self.records:
+            if self.speed:
+                if previous is not None:
+                    due += max(0.0, timestamp - previous) / self.speed
+                previous = timestamp
+                delay = self.started + due - time.monotonic()
+                if delay > 0:
+                    await writer.drain()
+                    await asyncio.sleep(delay)
+
+            writer.write(line + b'\r\n')
+            self.lines_replayed += 1
+            if not self.lines_replayed % 1000:
+                await writer.drain()
+
+        await writer.drain()
+        self.finished = time.monotonic()
+        self.done.set()
+
+
+async def replay(loop, args):
+    datadir = Path(tempfile.mkdtemp(prefix='sinap-replay-'))
+    records = read_capture(sorted(args.captures))
+
+    if args.output == '-':
+        output = sys.stdout.buffer
+    else:
+        output = open(args.output, 'wb')
+
+    server = ReplayServer(records, output, speed=args.speed,
+                          timestamps=args.timestamps)
+    port = await server.start()
+
+    config = replay_config(args.config, args.network, port, datadir)
+    config_file = datadir / 'config.yml'
+    with config_file.open('w') as fobj:
+        yaml.safe_dump(config, fobj)
+
+    bot = Bot(str(config_file), loop=loop)
+    bot.run()
+
+    try:
+        await server.done.wait()
+        # Let the modules finish replying to the last lines
+        await asyncio.sleep(args.grace)
+    finally:
+        server.stop()
+        for net in list(bot.networks.values()):
+            net.disconnect()
+        output.flush()
+        if output is not sys.stdout.buffer:
+            output.close()
+
+    if server.finished is not None:
+        duration = server.finished - server.started
+        sys.stderr.write(
+            'Replayed %d lines in %.2fs (%.0f lines/s), bot sent %d lines\n' %
+            (server.lines_replayed, duration,
+             server.lines_replayed / max(duration, 1e-6), server.lines_sent)
+        )
+    else:
+        sys.stderr.write('The bot disconnected after %d lines\n' %
+                         server.lines_replayed)
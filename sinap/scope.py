@@ -1,8 +1,18 @@
 class Scope(object):
-    def __init__(self, net, from_, to, raw=False):
+    __slots__ = ['net', 'user', 'trace', 'recorder', 'target']
+
+    def __init__(self, net, from_, to, raw=False, trace=None):
         self.net = net
         self.user = from_
 
+        # The sinap.trace.Trace of the message this scope was created
+        # for, if any
+        self.trace = trace
+
+        # A list that Module.say() appends the messages said to this
+        # scope to, for caching command replies, or None
+        self.recorder = None
+
         if not raw:
             if net.is_channel(to):
                 # Channel message
@@ -20,6 +30,6 @@ class Scope(object):
         return self.net.channel_matches(self.target, channel)
 
     def to(self, target):
-        copy = Scope(self.net, self.user, self.target)
+        copy = Scope(self.net, self.user, self.target, trace=self.trace)
         copy.target = target
         return copy
@@ -0,0 +1,192 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import sqlite3
+
+
+# Persistent storage for modules. Values are anything that can be
+# serialized as JSON. All data is read to memory when the storage is
+# opened, so reads never touch the disk. Writes update the memory copy
+# immediately and are written to an SQLite database in batches by a
+# background thread, each batch in a single transaction. Values
+# changed in place must be set() again to be written.
+#
+# Usage in modules:
+#
+#   self.store.set('counter', self.store.get('counter', 0) + 1)
+#
+#   karma = self.store.table('karma')
+#   karma.set(nick, {'score': 1, 'reason': 'being nice'})
+#   for nick, row in karma.find(score=1): ...
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS data (
+    namespace TEXT NOT NULL,
+    tbl TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (namespace, tbl, key)
+)
+'''
+
+# Marks a deleted key in the pending writes
+DELETED = object()
+
+
+class Table(object):
+    # A set of keys and values stored under a namespace. The
+    # namespace's own keys are a table with an empty name.
+
+    def __init__(self, storage, namespace, name):
+        self._storage = storage
+        self._namespace = namespace
+        self._name = name
+        self._data = storage._cache.setdefault((namespace, name), {})
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def set(self, key, value):
+        if not isinstance(key, str):
+            raise TypeError('Keys must be strings')
+        # Fail now rather than in the background thread
+        encoded = json.dumps(value)
+        self._data[key] = value
+        self._storage._write(self._namespace, self._name, key, encoded)
+
+    def delete(self, key):
+        if self._data.pop(key, DELETED) is not DELETED:
+            self._storage._write(self._namespace, self._name, key, DELETED)
+
+    def clear(self):
+        for key in list(self._data):
+            self.delete(key)
+
+    def keys(self):
+        return list(self._data)
+
+    def items(self):
+        return list(self._data.items())
+
+    def find(self, **match):
+        # Yield (key, row) for rows, i.e. dict values, whose fields
+        # equal all the given values
+        for key, row in list(self._data.items()):
+            if (isinstance(row, dict) and
+                    all(row.get(field) == value
+                        for field, value in match.items())):
+                yield key, row
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class Namespace(Table):
+    def __init__(self, storage, namespace):
+        super().__init__(storage, namespace, '')
+
+    def table(self, name):
+        if not name:
+            raise ValueError('Table name must not be empty')
+        return Table(self._storage, self._namespace, name)
+
+
+class Storage(object):
+    def __init__(self, loop, path, logger, flush_delay=1.0):
+        self.loop = loop
+        self.path = str(path)
+        self.log = logger
+        self.flush_delay = flush_delay
+
+        # (namespace, table) -> {key: value}
+        self._cache = {}
+
+        # (namespace, table, key) -> JSON encoded value or DELETED
+        self._pending = {}
+        self._flush_handle = None
+
+        # SQLite connections may only be used by the thread that
+        # created them, so all database access happens in this one
+        # thread, in the order submitted
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._executor.submit(self._open).result()
+
+    def namespace(self, name):
+        return Namespace(self, name)
+
+    def flush(self):
+        # Write pending changes in the background. Returns a
+        # concurrent.futures.Future.
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._pending = self._pending, {}
+        future = self._executor.submit(self._commit, batch)
+        future.add_done_callback(
+            lambda future: self.loop.call_soon_threadsafe(
+                self._committed, future, batch
+            )
+        )
+        return future
+
+    def close(self):
+        # Write everything and close the database, blocking until done
+        self.flush().result()
+        self._executor.submit(self._db.close).result()
+        self._executor.shutdown()
+
+    def _write(self, namespace, table, key, value):
+        self._pending[(namespace, table, key)] = value
+        if self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(self.flush_delay,
+                                                      self.flush)
+
+    def _committed(self, future, batch):
+        if future.exception() is None:
+            return
+
+        self.log.error('Writing to %s failed, retrying: %s',
+                       self.path, future.exception())
+
+        # Retry the failed writes unless the keys have been written
+        # again meanwhile
+        for key, value in batch.items():
+            self._pending.setdefault(key, value)
+        if self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(
+                max(self.flush_delay, 5), self.flush
+            )
+
+    # The rest run in the executor thread
+
+    def _open(self):
+        self._db = sqlite3.connect(self.path)
+        # With the write-ahead log, a crash in the middle of a commit
+        # leaves the previous commit intact
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(SCHEMA)
+        self._db.commit()
+
+        for namespace, table, key, value in self._db.execute(
+                'SELECT namespace, tbl, key, value FROM data'):
+            self._cache.setdefault((namespace, table), {})[key] = \
+                json.loads(value)
+
+    def _commit(self, batch):
+        if not batch:
+            return
+
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO data VALUES (?, ?, ?, ?)',
+                [key + (value,) for key, value in batch.items()
+                 if value is not DELETED],
+            )
+            self._db.executemany(
+                'DELETE FROM data WHERE namespace = ? AND tbl = ? AND key = ?',
+                [key for key, value in batch.items() if value is DELETED],
+            )
@@ -0,0 +1,337 @@
+from pathlib import Path
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+import tempfile
+
+import yaml
+
+
+# Methods of IRCConnection that may be called on a network owned by
+# another worker
+REMOTE_METHODS = ('privmsg', 'join', 'part', 'send_message')
+
+# Seconds between reports of a worker's send queue depths to the others
+PENDING_INTERVAL = 0.25
+
+
+def assign_networks(net_configs, workers):
+    # Return a netname -> worker index mapping. A network can be
+    # pinned to a worker with the worker option, the rest are
+    # distributed round robin in name order.
+    assignment = {}
+    unpinned = []
+    for netname, config in sorted(net_configs.items()):
+        worker = (config or {}).get('worker')
+        if worker is not None:
+            assignment[netname] = int(worker) % workers
+        else:
+            unpinned.append(netname)
+
+    for i, netname in enumerate(unpinned):
+        assignment[netname] = i % workers
+
+    return assignment
+
+
+def ipc_path(config):
+    if 'datadir' in config:
+        datadir = Path(config['datadir'])
+        if not datadir.exists():
+            datadir.mkdir(parents=True)
+        return str(datadir / 'sinap.sock')
+    return str(Path(tempfile.mkdtemp(prefix='sinap-')) / 'sinap.sock')
+
+
+def encode(message):
+    return json.dumps(message).encode('utf-8') + b'\n'
+
+
+class RemoteNetwork(object):
+    # Stands in for a network owned by another worker. Supports the
+    # parts of the IRCConnection interface that make sense without
+    # local connection state.
+
+    def __init__(self, link, name):
+        self.name = name
+        self.channels = {}
+        self._link = link
+
+        # Messages sent since the owning worker last reported its send
+        # queue depth
+        self._unreported = 0
+
+    def is_channel(self, name):
+        return name.startswith(('&', '#', '+', '!'))
+
+    def channel_matches(self, name1, name2):
+        return name1 == name2
+
+    def _call(self, method, *args):
+        self._unreported += 1
+        self._link.send({
+            'type': 'call',
+            'network': self.name,
+            'method': method,
+            'args': list(args),
+        })
+
+    def privmsg(self, target, message, trace=None):
+        # Traces don't cross process boundaries
+        self._call('privmsg', target, message)
+
+    def join(self, channel, key=None):
+        self._call('join', channel, key)
+
+    def part(self, channel, message=None):
+        self._call('part', channel, message)
+
+    def send_message(self, command, *args):
+        self._call('send_message', command, *args)
+
+    def pending_sends(self):
+        # The owning worker's last reported send queue depth, plus
+        # what has been sent to it since
+        return self._link.pending.get(self.name, 0) + self._unreported
+
+    def pending_reported(self):
+        self._unreported = 0
+
+
+class WorkerLink(object):
+    # A worker's connection to the supervisor
+
+    def __init__(self, bot, path):
+        self.bot = bot
+        self.path = path
+
+        # Replaced with the bot's logger in run(), when the bot's
+        # logging has been set up
+        self.log = logging.getLogger('sinap.loggers.ipc')
+
+        self._writer = None
+
+        # netname -> send queue depth reported by the owning worker
+        self.pending = {}
+
+        # Last reported depths of the own networks, and whether calls
+        # have been handled since
+        self._reported = None
+        self._called = False
+
+    async def run(self):
+        self.log = self.bot.logger('ipc')
+        self.bot.loop.create_task(self._report_pending())
+
+        while True:
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(
+                    self.path,
+                )
+            except OSError as exc:
+                self.log.warning('Unable to connect to supervisor: %s' % exc)
+                await asyncio.sleep(1)
+                continue
+
+            self.send({'type': 'hello', 'worker': self.bot.worker})
+            self._reported = None
+
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                try:
+                    self.handle(json.loads(line.decode('utf-8')))
+                except Exception:
+                    self.log.exception('Invalid message from supervisor')
+
+            self.log.warning('Lost connection to supervisor')
+            self._writer = None
+            await asyncio.sleep(1)
+
+    def send(self, message):
+        if self._writer is None:
+            self.log.warning('Not connected to supervisor, dropping %s' %
+                             message.get('type'))
+            return
+        self._writer.write(encode(message))
+
+    async def _report_pending(self):
+        # Let the other workers know how busy the own networks are, so
+        # that e.g. relays don't hand them more than they can send.
+        # Reported when the depths change, and after handling calls
+        # from other workers, which resets their count of messages
+        # sent since the last report.
+        while True:
+            await asyncio.sleep(PENDING_INTERVAL)
+            if self._writer is None:
+                continue
+
+            depths = {
+                netname: net.pending_sends()
+                for netname, net in self.bot.networks.items()
+            }
+            if depths != self._reported or self._called:
+                self.send({'type': 'pending', 'networks': depths})
+                self._reported = depths
+                self._called = False
+
+    def handle(self, message):
+        if message['type'] == 'pending':
+            self.pending.update(message['networks'])
+            for netname in message['networks']:
+                net = self.bot.remote_networks.get(netname)
+                if net is not None:
+                    net.pending_reported()
+        elif message['type'] == 'call':
+            net = self.bot.networks.get(message['network'])
+            method = message['method']
+            if net is None or method not in REMOTE_METHODS:
+                self.log.warning('Unable to call %s on %s' % (
+                    method, message['network'],
+                ))
+                return
+
+            self._called = True
+            args = message['args']
+            if method == 'part':
+                # Translate safe channel's short name to long if needed
+                args[0] = net.channels.get(args[0], args[0])
+            getattr(net, method)(*args)
+
+
+class Supervisor(object):
+    # Runs one bot process per worker, each owning a subset of the
+    # networks, and routes messages between them
+
+    def __init__(self, config_file, workers, loop=None):
+        self.config_file = config_file
+        self.workers = workers
+        self.loop = loop or asyncio.get_event_loop()
+        self.log = logging.getLogger('sinap.loggers.supervisor')
+        self.log.setLevel('INFO')
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(
+            '[%%(asctime)-15s][%-20s] %%(levelname)s %%(message)s' %
+            'supervisor'
+        ))
+        self.log.addHandler(handler)
+
+        self.load_config()
+        self.path = ipc_path(self.config)
+
+        # worker index -> asyncio.subprocess.Process
+        self.processes = {}
+
+        # worker index -> StreamWriter
+        self.links = {}
+
+        self._stopping = False
+
+    def load_config(self):
+        with open(self.config_file) as fobj:
+            self.config = yaml.safe_load(fobj)
+        self.assignment = assign_networks(
+            self.config.get('networks', {}), self.workers,
+        )
+
+    def run(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        # Only this user may connect to the socket, anyone who can
+        # could make the bot say things
+        umask = os.umask(0o177)
+        try:
+            self.loop.run_until_complete(
+                asyncio.start_unix_server(self.handle_worker, self.path)
+            )
+        finally:
+            os.umask(umask)
+        for index in range(self.workers):
+            self.loop.create_task(self.supervise(index))
+
+        self.loop.add_signal_handler(signal.SIGUSR1, self.reload)
+        self.loop.add_signal_handler(signal.SIGTERM, self.stop)
+        self.loop.add_signal_handler(signal.SIGINT, self.stop)
+
+    def reload(self):
+        self.log.info('Reloading configuration')
+        self.load_config()
+        for process in self.processes.values():
+            process.send_signal(signal.SIGUSR1)
+
+    def stop(self):
+        self._stopping = True
+        for process in self.processes.values():
+            process.terminate()
+        self.loop.call_later(1, self.loop.stop)
+
+    async def supervise(self, index):
+        args = [
+            sys.executable, sys.argv[0],
+            '--config', self.config_file,
+            '--worker', str(index),
+            '--workers', str(self.workers),
+            '--ipc', self.path,
+        ]
+        while not self._stopping:
+            self.log.info('Starting worker %d' % index)
+            process = await asyncio.create_subprocess_exec(*args)
+            self.processes[index] = process
+
+            # A worker restarting itself with exec keeps its pid, so
+            # this only returns when the worker really exits
+            status = await process.wait()
+            del self.processes[index]
+            if self._stopping:
+                break
+
+            self.log.warning('Worker %d exited with status %s' %
+                             (index, status))
+            await asyncio.sleep(2)
+
+    async def handle_worker(self, reader, writer):
+        index = None
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+
+            try:
+                message = json.loads(line.decode('utf-8'))
+            except ValueError:
+                self.log.warning('Invalid message from worker %s' % index)
+                continue
+
+            if message['type'] == 'hello':
+                index = message['worker']
+                self.links[index] = writer
+            elif message['type'] == 'call':
+                self.route(message)
+            elif message['type'] == 'pending':
+                self.broadcast(message, index)
+            elif message['type'] == 'reload':
+                self.reload()
+
+        if index is not None and self.links.get(index) is writer:
+            del self.links[index]
+
+    def broadcast(self, message, sender):
+        # Send to all workers except the sender
+        data = encode(message)
+        for index, writer in self.links.items():
+            if index != sender:
+                writer.write(data)
+
+    def route(self, message):
+        worker = self.assignment.get(message['network'])
+        writer = self.links.get(worker)
+        if writer is None:
+            self.log.warning('No worker for network %s' % message['network'])
+            return
+        writer.write(encode(message))
@@ -0,0 +1,78 @@
+import collections
+import time
+
+
+STAGES = ('parse', 'dispatch', 'handler', 'send_queue')
+
+
+class Trace(object):
+    # Timestamps (time.monotonic()) of one received line on its way
+    # to a reply:
+    #
+    #   received     the data was read from the socket
+    #   dispatched   the bot started processing the parsed message
+    #   started      the module's handler was called
+    #
+    # Each reply line adds the time it was queued and sent.
+
+    __slots__ = ['command', 'module', 'received', 'dispatched', 'started']
+
+    def __init__(self, command, received, dispatched):
+        self.command = command
+        self.module = None
+        self.received = received
+        self.dispatched = dispatched
+        self.started = None
+
+    def stages(self, queued_at, sent_at):
+        started = self.started or self.dispatched
+        return (
+            ('parse', self.dispatched - self.received),
+            ('dispatch', started - self.dispatched),
+            ('handler', queued_at - started),
+            ('send_queue', sent_at - queued_at),
+        )
+
+
+class Tracer(object):
+    def __init__(self, metrics, slow_threshold=2.0, keep=100):
+        self.slow_threshold = slow_threshold
+        self.stage_seconds = metrics.histogram(
+            'sinap_reply_stage_seconds',
+            'Time spent in each stage between a received line and a reply',
+            ['command', 'module', 'stage'],
+        )
+
+        # Most recent replies that took longer than slow_threshold
+        self.slow = collections.deque(maxlen=keep)
+
+    def configure(self, slow_threshold=2.0, keep=100):
+        self.slow_threshold = slow_threshold
+        if keep != self.slow.maxlen:
+            self.slow = collections.deque(self.slow, maxlen=keep)
+
+    def start(self, command, received):
+        # received may be None for messages that weren't stamped
+        now = time.monotonic()
+        return Trace(command, received or now, now)
+
+    def finish(self, trace, netname, target, queued_at, sent_at):
+        # Called for each reply line written to the socket
+        module = trace.module or 'core'
+        stages = trace.stages(queued_at, sent_at)
+        for stage, seconds in stages:
+            self.stage_seconds.labels(trace.command, module, stage).observe(
+                seconds
+            )
+
+        total = sent_at - trace.received
+        if total >= self.slow_threshold:
+            self.slow.append({
+                'time': time.time(),
+                'network': netname,
+                'target': target,
+                'command': trace.command,
+                'module': module,
+                'total': total,
+                'stages': dict(stages),
+            })
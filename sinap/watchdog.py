@@ -0,0 +1,155 @@
+import collections
+import sys
+import threading
+import time
+import traceback
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Watchdog(object):
+    # Measures how late the event loop runs a periodic timer. A
+    # helper thread notices when the loop hasn't run the timer for
+    # longer than threshold seconds, takes a sample of the loop
+    # thread's stack and finds out which module's code it is running.
+
+    def __init__(self, bot, interval=0.25, threshold=0.5, disable_after=None):
+        self.bot = bot
+        self.loop = bot.loop
+        self.log = bot.logger('watchdog')
+        self.configure(interval, threshold, disable_after)
+
+        # Recent lag samples in seconds
+        self.lags = collections.deque(maxlen=1000)
+
+        # qualified module name -> number of times it blocked the loop
+        self.violations = collections.Counter()
+
+        self.lag_seconds = bot.metrics.histogram(
+            'sinap_loop_lag_seconds', 'Event loop lag',
+        )
+        lag_percentiles = bot.metrics.gauge(
+            'sinap_loop_lag_percentile_seconds',
+            'Event loop lag percentiles over the recent samples',
+            ['quantile'],
+        )
+        for fraction in (0.5, 0.9, 0.99):
+            lag_percentiles.labels(str(fraction)).set_function(
+                lambda fraction=fraction: percentile(self.lags, fraction)
+            )
+        self.blocked_count = bot.metrics.counter(
+            'sinap_loop_blocked_total',
+            'Times a module blocked the event loop for longer than the '
+            'watchdog threshold', ['module'],
+        )
+
+        self._thread = None
+        self._stopped = None
+        self._handle = None
+        self._running = False
+        self._loop_thread_id = None
+        self._expected = None
+        self._last_tick = time.monotonic()
+
+        # Set by the watchdog thread when the loop is stuck, consumed
+        # by the next tick: (module, stack)
+        self._stall = None
+
+    def configure(self, interval=0.25, threshold=0.5, disable_after=None):
+        self.interval = interval
+        self.threshold = threshold
+        self.disable_after = disable_after
+
+    def start(self):
+        # Must be called from the event loop thread
+        if self._running:
+            return
+
+        self._running = True
+        self._loop_thread_id = threading.get_ident()
+        self._schedule()
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._watch, name='watchdog',
+                                        args=(self._stopped,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
+
+        # Wait for the thread, so that a start() right after this
+        # doesn't leave two of them running
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def _schedule(self):
+        self._last_tick = time.monotonic()
+        self._expected = self.loop.time() + self.interval
+        self._handle = self.loop.call_later(self.interval, self._tick)
+
+    def _tick(self):
+        lag = max(0.0, self.loop.time() - self._expected)
+        self.lags.append(lag)
+        self.lag_seconds.observe(lag)
+
+        stall, self._stall = self._stall, None
+        if stall:
+            module, stack = stall
+            self.log.warning('Event loop blocked for %.2fs by %s:\n%s' % (
+                lag, module or 'unknown code', stack,
+            ))
+            if module:
+                self.report(module)
+
+        self._schedule()
+
+    def report(self, module):
+        # Called when module has blocked the loop for too long
+        self.violations[module] += 1
+        self.blocked_count.labels(module).inc()
+
+        if (self.disable_after and
+                self.violations[module] >= self.disable_after and
+                module in self.bot.modules):
+            self.log.error('Disabling module %s, it blocked the event loop '
+                           '%d times' % (module, self.violations[module]))
+            self.bot.disable_module(module)
+
+    def _watch(self, stopped):
+        # Runs in the watchdog thread until stopped is set
+        while not stopped.wait(self.interval / 2):
+
+            stalled_for = time.monotonic() - self._last_tick - self.interval
+            if stalled_for < self.threshold or self._stall is not None:
+                continue
+
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+
+            self._stall = (
+                self.find_module(frame),
+                ''.join(traceback.format_stack(frame)),
+            )
+
+    def find_module(self, frame):
+        # Return the qualified name of the innermost module whose
+        # code is on the stack
+        module_files = self.bot.module_files
+        while frame is not None:
+            module = module_files.get(frame.f_code.co_filename)
+            if module:
+                return module
+            frame = frame.f_back
+        return None